@@ -0,0 +1,356 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import flac2lib
+
+
+# results where a bigger number is better, everything else is a cost
+HIGHER_IS_BETTER = {"tracks_per_s", "mb_per_s"}
+
+
+def main():
+    '''Generates a synthetic library of flac albums with ffmpeg (cached in
+       the corpus directory, so repeated runs measure the same files), times
+       the stages of flac2lib on it and optionally compares the results with
+       a stored baseline. Exits with 1 if anything got slower than the
+       baseline by more than the tolerance.'''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=None, type=str,
+                        help="where to generate the synthetic library, a "
+                        + "temporary directory by default")
+    parser.add_argument("--albums", default=12, type=int,
+                        help="number of albums to generate")
+    parser.add_argument("--tracks", default=8, type=int,
+                        help="maximum number of tracks per album")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="seed for the random parts of the corpus")
+    parser.add_argument("--repeat", default=5, type=int,
+                        help="how many times the quick benchmarks are "
+                        + "repeated, the median is used")
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+                        help="worker processes used for converting")
+    parser.add_argument("--skip-convert", action="store_true",
+                        help="only benchmark scanning, tags and cover art")
+    parser.add_argument("--save-baseline", default=None, type=str,
+                        help="store the results as a baseline json file")
+    parser.add_argument("--baseline", default=None, type=str,
+                        help="compare the results with a baseline json file")
+    parser.add_argument("--tolerance", default=0.2, type=float,
+                        help="allowed slowdown against the baseline, 0.2 "
+                        + "means 20%%")
+    # used internally to convert in a fresh process, so that peak RSS
+    # of one mode doesn't hide the other
+    parser.add_argument("--convert-only", default=None,
+                        choices=["pydub", "direct"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg is needed to generate the corpus")
+
+    if args.corpus is None:
+        corpus_dir = Path(tempfile.gettempdir()) / "flac2lib_bench_corpus"
+    else:
+        corpus_dir = Path(args.corpus)
+    generate_corpus(corpus_dir, args.albums, args.tracks, args.seed)
+
+    if args.convert_only is not None:
+        print(json.dumps(bench_convert(corpus_dir, args.convert_only,
+                                       args.jobs)))
+        return
+
+    results = {}
+    results.update(bench_startup(corpus_dir, args.repeat))
+    results.update(bench_scanning(corpus_dir, args.repeat))
+    results["tag_lookup"] = bench_tag_lookup(corpus_dir, args.repeat)
+    results["cover_art_listing"] = bench_cover_art_listing(corpus_dir,
+                                                           args.repeat)
+    if not args.skip_convert:
+        for mode in ["pydub", "direct"]:
+            process = subprocess.run([sys.executable, __file__,
+                                      "--corpus", str(corpus_dir),
+                                      "--albums", str(args.albums),
+                                      "--tracks", str(args.tracks),
+                                      "--seed", str(args.seed),
+                                      "--jobs", str(args.jobs),
+                                      "--convert-only", mode],
+                                     capture_output=True, text=True)
+            if process.returncode != 0:
+                print(f"Converting with {mode} failed:\n{process.stderr}")
+                continue
+            results[f"convert_{mode}"] = json.loads(
+                process.stdout.strip().splitlines()[-1])
+
+    print_results(results)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved as {args.save_baseline}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare_with_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+def generate_corpus(corpus_dir, albums, tracks, seed) -> None:
+    '''Generates 'albums' albums of sine wave flac files with ffmpeg. Track
+       counts, durations, sample rates, bit depths, tag spellings and cover
+       images (including a scans folder with large pages) vary between the
+       albums, but are always the same for the same arguments. An existing
+       corpus generated with the same arguments is reused.'''
+
+    spec = {"albums": albums, "tracks": tracks, "seed": seed, "version": 1}
+    spec_path = corpus_dir / "corpus.json"
+    try:
+        with open(spec_path) as f:
+            if json.load(f) == spec:
+                return
+    except (OSError, ValueError):
+        pass
+
+    print(f"Generating the corpus in {corpus_dir}...")
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    rng = random.Random(seed)
+    library = corpus_dir / "library"
+    for a in range(albums):
+        artist = f"Artist {a % 5}"
+        album = f"Album {a}"
+        album_dir = library / artist / album
+        sample_rate = rng.choice([44100, 48000, 96000, 192000])
+        bits = rng.choice([16, 24])
+        # some files spell their tags in lower case, like the ones
+        # get_dst_album_path loops over
+        artist_key, album_key = rng.choice([("ARTIST", "ALBUM"),
+                                            ("artist", "album"),
+                                            ("Artist", "Album")])
+        # every fourth album is a multi-CD one
+        cds = ["CD1", "CD2"] if a % 4 == 3 else [""]
+        track_count = rng.randint(max(1, tracks // 2), tracks)
+        for t in range(track_count):
+            cd = cds[t % len(cds)]
+            duration = rng.choice([5, 15, 30, 60])
+            flac_path = album_dir / cd / f"{t + 1:02} - Track {t + 1}.flac"
+            flac_path.parent.mkdir(parents=True, exist_ok=True)
+            tags = {artist_key: artist, album_key: album,
+                    "TITLE": f"Track {t + 1}", "TRACKNUMBER": str(t + 1),
+                    "DATE": str(1970 + a), "GENRE": rng.choice(
+                        ["Rock", "Jazz", "Classical", "Electronic"])}
+            command = ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i",
+                       f"sine=frequency={rng.randint(110, 880)}"
+                       + f":sample_rate={sample_rate}:duration={duration}",
+                       "-ac", "2",
+                       "-sample_fmt", "s16" if bits == 16 else "s32",
+                       "-bits_per_raw_sample", str(bits)]
+            for key, value in tags.items():
+                command.extend(["-metadata", f"{key}={value}"])
+            command.append(str(flac_path))
+            subprocess.run(command, check=True)
+
+        cover_size = rng.choice([500, 1200, 3000])
+        generate_image(album_dir / "cover.jpg", cover_size, cover_size, rng)
+        if a % 3 == 0:
+            for page in range(rng.randint(2, 6)):
+                generate_image(album_dir / "Scans" / f"{page + 1:02}.png",
+                               4000, 4000, rng)
+
+    # album folders get fixed modification times, newest last, so scans
+    # and --latest always see them in the same order
+    for a, album_dir in enumerate(sorted(library.glob("*/*"))):
+        for folder in [album_dir] + [x for x in album_dir.iterdir()
+                                     if x.is_dir()]:
+            os.utime(folder, (1600000000 + a * 60, 1600000000 + a * 60))
+
+    spec_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(spec_path, "w") as f:
+        json.dump(spec, f)
+
+
+def generate_image(image_path, width, height, rng) -> None:
+    image_path.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i",
+                    f"color=c=0x{rng.randint(0, 0xffffff):06x}"
+                    + f":s={width}x{height}", "-frames:v", "1",
+                    str(image_path)], check=True)
+
+
+def median_time(function, repeat) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def get_albums(library) -> list:
+    return sorted({x.parent for x in library.rglob("*.flac")})
+
+
+def bench_startup(corpus_dir, repeat) -> dict:
+    '''Times a fresh python process importing flac2lib and reading the
+       config like every run does before showing anything, once with the
+       cached config and once with the cache removed first. Also reports
+       the peak RSS of such a process.'''
+
+    config_path = corpus_dir / "config.yaml"
+    config = (Path(__file__).parent / "config.yaml").read_text()
+    config = config.replace("flac_albums_dir:",
+                            f"flac_albums_dir: {corpus_dir / 'library'}")
+    config = config.replace("dst_albums_dir:",
+                            f"dst_albums_dir: {corpus_dir / 'converted'}")
+    config_path.write_text(config)
+    cache_path = config_path.with_name(f".{config_path.name}.json")
+    code = ("import resource, flac2lib; "
+            + "flac2lib.parse_args_and_config(flac2lib.get_arg_parser()"
+            + f".parse_args(['-c', {str(config_path)!r}])); "
+            + "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(
+        [str(Path(__file__).parent)]
+        + os.environ.get("PYTHONPATH", "").split(os.pathsep))}
+
+    def start():
+        process = subprocess.run([sys.executable, "-c", code], env=env,
+                                 capture_output=True, text=True, check=True)
+        return int(process.stdout.strip())
+
+    def start_cold():
+        cache_path.unlink(missing_ok=True)
+        start()
+
+    start()
+    # ru_maxrss is in kilobytes on Linux
+    return {"startup_cached": {"seconds": median_time(start, repeat),
+                               "peak_rss_mb": start() / 1e3},
+            "startup_uncached": {"seconds": median_time(start_cold,
+                                                        repeat)}}
+
+
+def bench_scanning(corpus_dir, repeat) -> dict:
+    '''Times get_flac_album_path with the AlbumScanner walking the whole
+       library and with the library index, both built from scratch and
+       refreshed.'''
+
+    library = corpus_dir / "library"
+    index_path = corpus_dir / "library_index.json"
+
+    def scan_cold():
+        index_path.unlink(missing_ok=True)
+        flac2lib.get_flac_album_path(library, 10, True,
+                                     flac2lib.LibraryIndex(library,
+                                                           index_path))
+
+    def scan_warm():
+        flac2lib.get_flac_album_path(library, 10, True,
+                                     flac2lib.LibraryIndex(library,
+                                                           index_path))
+
+    return {"scan_walk": {"seconds": median_time(
+                lambda: flac2lib.get_flac_album_path(library, 10, True),
+                repeat)},
+            "scan_index_cold": {"seconds": median_time(scan_cold, repeat)},
+            "scan_index_warm": {"seconds": median_time(scan_warm, repeat)}}
+
+
+def bench_tag_lookup(corpus_dir, repeat) -> dict:
+    '''Times reading ARTIST and ALBUM of the first song of every album, the
+       lookup get_dst_album_path does.'''
+
+    first_songs = [flac2lib.pick_songs(x, True)[0]
+                   for x in get_albums(corpus_dir / "library")]
+    seconds = median_time(lambda: [flac2lib.get_artist_and_album(x)
+                                   for x in first_songs], repeat)
+    return {"seconds": seconds}
+
+
+def bench_cover_art_listing(corpus_dir, repeat) -> dict:
+    '''Times listing the cover art of every album along with the image
+       sizes, like get_cover_art does before asking anything.'''
+
+    albums = get_albums(corpus_dir / "library")
+
+    def list_all():
+        for album in albums:
+            flac2lib.list_cover_art(album, ["jpg", "png", "jpeg"])
+
+    return {"seconds": median_time(list_all, repeat)}
+
+
+def bench_convert(corpus_dir, mode, jobs) -> dict:
+    '''Converts the whole library into mp3 V2 with pydub or the direct ffmpeg
+       transcode. Reports songs and source megabytes per second and the peak
+       RSS of this process and of the largest worker or ffmpeg process.'''
+
+    library = corpus_dir / "library"
+    with tempfile.TemporaryDirectory() as dst_dir:
+        albums = []
+        for flac_album_path in get_albums(library):
+            albums.append(flac2lib.AlbumToProcess(
+                Path(dst_dir) / flac_album_path.relative_to(library),
+                flac2lib.pick_songs(flac_album_path, True), flac_album_path,
+                "-q:a 2", "mp3", False, mode == "direct"))
+        songs = [x for album in albums for x in album.picks_paths]
+        size = sum(x.stat().st_size for x in songs)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = flac2lib.convert_songs(albums, jobs)
+        seconds = time.perf_counter() - start
+
+    failed = [x for x in results if x["status"] == "failed"]
+    if failed:
+        raise RuntimeError(f"{len(failed)} songs failed: {failed[0]}")
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {"seconds": seconds, "tracks_per_s": len(songs) / seconds,
+            "mb_per_s": size / 1e6 / seconds, "peak_rss_mb": peak_rss / 1e3}
+
+
+def print_results(results) -> None:
+    print("\n--- Results ---\n")
+    for name, values in results.items():
+        line = ", ".join(f"{key} {value:.4f}"
+                         for key, value in values.items())
+        print(f"{name:<20}{line}")
+
+
+def compare_with_baseline(results, baseline, tolerance) -> bool:
+    '''Prints the change of every result against the baseline and returns
+       False if any of them got worse by more than the tolerance.'''
+
+    print("\n--- Compared with the baseline ---\n")
+    ok = True
+    for name, values in results.items():
+        for key, value in values.items():
+            old = baseline.get(name, {}).get(key)
+            if not old:
+                continue
+            change = (value - old) / old
+            if key in HIGHER_IS_BETTER:
+                regressed = change < -tolerance
+            else:
+                regressed = change > tolerance
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:<20}{key:<14}{old:>10.4f} -> {value:>10.4f}"
+                  + f" ({change:+.1%}){flag}")
+            ok = ok and not regressed
+    return ok
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,780 @@
 import argparse
-import cv2
+import csv
+import ctypes
+import errno
+import hashlib
+import heapq
+import io
+import json
+import math
+import os
+import re
+import select
 import shutil
+import struct
+import subprocess
 import sys
-import yaml
-import webbrowser
+import tempfile
+import threading
+import time
+from concurrent.futures import BrokenExecutor, Future
+from concurrent.futures import wait as futures_wait
+from contextlib import contextmanager
 from pathlib import Path
-from pydub import AudioSegment
-from pydub.utils import mediainfo
-from urllib.parse import urlencode
-from urllib.request import urlopen
+# yaml, pydub, webbrowser, urllib and the executors of concurrent.futures
+# are imported where they're used, so that runs which don't need them (and
+# starting up in general) don't wait for them
+
+
+class OutputTarget:
+    def __init__(self, dst_album_path, dst_format, ffmpeg_params):
+        self.dst_path = dst_album_path
+        self.dst_format = dst_format
+        self.ffmpeg_params = ffmpeg_params
 
 
 class AlbumToProcess:
     def __init__(self, dst_album_path, song_picks_paths, flac_album_path,
-                 ffmpeg_params, dst_format, is_compilation):
+                 ffmpeg_params, dst_format, is_compilation,
+                 direct_transcode=False, extra_targets=None,
+                 replaygain=False):
         self.dst_path = dst_album_path
         self.picks_paths = song_picks_paths
         self.flac_path = flac_album_path
         self.ffmpeg_params = ffmpeg_params
         self.dst_format = dst_format
         self.is_compilation = is_compilation
+        self.direct_transcode = direct_transcode
+        self.replaygain = replaygain
+        # every song is decoded once and encoded into all the targets, the
+        # first one being dst_path / dst_format / ffmpeg_params
+        self.targets = ([OutputTarget(dst_album_path, dst_format,
+                                      ffmpeg_params)]
+                        + (extra_targets or []))
+
+    def to_dict(self) -> dict:
+        return {"dst_path": str(self.dst_path),
+                "picks_paths": [str(x) for x in self.picks_paths],
+                "flac_path": str(self.flac_path),
+                "ffmpeg_params": self.ffmpeg_params,
+                "dst_format": self.dst_format,
+                "is_compilation": self.is_compilation,
+                "direct_transcode": self.direct_transcode,
+                "extra_targets": [[str(x.dst_path), x.dst_format,
+                                   x.ffmpeg_params]
+                                  for x in self.targets[1:]],
+                "replaygain": self.replaygain}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(Path(data["dst_path"]),
+                   [Path(x) for x in data["picks_paths"]],
+                   Path(data["flac_path"]), data["ffmpeg_params"],
+                   data["dst_format"], data["is_compilation"],
+                   data["direct_transcode"],
+                   [OutputTarget(Path(x), y, z)
+                    for x, y, z in data["extra_targets"]],
+                   data.get("replaygain", False))
+
+
+class LibraryIndex:
+    '''An on-disk index of every folder inside flac_albums_dir with its mtime,
+       subfolders, flac files and (read lazily) the tags of its first song.
+       refresh() only lists folders whose mtime changed since the last time,
+       the rest is taken straight from the index, so only folders have to be
+       stat'ed instead of walking every file.'''
+
+    version = 1
+
+    def __init__(self, flac_albums_dir, index_path):
+        self.root = flac_albums_dir
+        self.path = index_path
+        self.dirs = {}
+        self.refreshed = False
+        # tags were read since the last save
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if (data["version"] == self.version
+                    and data["root"] == str(self.root)):
+                self.dirs = data["dirs"]
+        except (OSError, ValueError, KeyError):
+            # a missing or broken index is simply rebuilt
+            pass
+
+    def save(self) -> None:
+        write_json(self.path, {"version": self.version,
+                               "root": str(self.root), "dirs": self.dirs})
+        self.dirty = False
+
+    def flush(self) -> None:
+        '''Saves the tags read by first_track_tags since the last save.'''
+
+        if self.dirty:
+            self.save()
+
+    def refresh(self) -> None:
+        '''Walks the folder tree, rescanning only folders with a changed mtime
+           and dropping the ones that no longer exist.'''
+
+        dirs = {}
+        changed = False
+        to_visit = [""]
+        while to_visit:
+            rel = to_visit.pop()
+            try:
+                mtime = (self.root / rel).stat().st_mtime
+            except OSError:
+                changed = True
+                continue
+            entry = self.dirs.get(rel)
+            if entry is None or entry["mtime"] != mtime:
+                old_entry = entry
+                entry = self._scan_dir(rel, mtime)
+                if old_entry is not None:
+                    # first_track_tags checks whether these are still valid
+                    entry["tags"] = old_entry["tags"]
+                changed = True
+            dirs[rel] = entry
+            to_visit.extend(f"{rel}/{x}" if rel else x
+                            for x in entry["subdirs"])
+
+        if changed or len(dirs) != len(self.dirs):
+            self.dirs = dirs
+            self.save()
+        self.refreshed = True
+
+    def _scan_dir(self, rel, mtime) -> dict:
+        subdirs = []
+        tracks = []
+        with os.scandir(self.root / rel) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.name.endswith(".flac"):
+                    tracks.append(entry.name)
+        return {"mtime": mtime, "subdirs": sorted(subdirs),
+                "tracks": sorted(tracks), "tags": None}
+
+    def _rel(self, path):
+        try:
+            rel = Path(path).relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+        return "" if rel == "." else rel
+
+    def albums(self) -> list:
+        '''Returns the paths of all folders containing flac files (except
+           flac_albums_dir itself), most recently modified first.'''
+
+        albums = [(entry["mtime"], rel) for rel, entry in self.dirs.items()
+                  if rel and entry["tracks"]]
+        albums.sort(reverse=True)
+        return [self.root / rel for _, rel in albums]
+
+    def tracks(self, album_path):
+        '''Returns all flac files in album_path and its subfolders sorted the
+           same way pick_songs sorts them, or None when the album isn't in
+           an index refreshed during this run.'''
+
+        rel = self._rel(album_path)
+        if not self.refreshed or rel not in self.dirs:
+            return None
+        tracks = []
+        to_visit = [rel]
+        while to_visit:
+            current = to_visit.pop()
+            entry = self.dirs.get(current)
+            if entry is None:
+                continue
+            tracks.extend(self.root / current / x for x in entry["tracks"])
+            to_visit.extend(f"{current}/{x}" if current else x
+                            for x in entry["subdirs"])
+        return sorted(tracks)
+
+    def first_track_tags(self, track_path):
+        '''Returns the tags of track_path in the same shape as
+           read_flac_metadata if it's the first song of an indexed folder,
+           reading them only if the song changed since they were stored.
+           Returns None for any other file.'''
+
+        rel = self._rel(track_path.parent)
+        entry = self.dirs.get(rel)
+        if (entry is None or not entry["tracks"]
+                or entry["tracks"][0] != track_path.name):
+            return None
+        try:
+            track_mtime = track_path.stat().st_mtime
+        except OSError:
+            return None
+        tags = entry["tags"]
+        if (tags is None or tags["track"] != track_path.name
+                or tags["mtime"] != track_mtime):
+            tags = {"track": track_path.name, "mtime": track_mtime,
+                    "TAG": read_flac_metadata(track_path)['TAG']}
+            entry["tags"] = tags
+            # saved once the queue is built, see flush
+            self.dirty = True
+        return {'TAG': dict(tags["TAG"])}
+
+
+class AlbumScanner:
+    '''Looks for the 'limit' most recently modified folders with flac files
+       inside flac_albums_dir in background threads, so the album list can be
+       shown before the whole library was looked through. Folders are listed
+       with os.scandir by several threads at once (which helps most on
+       network shares) and a folder with flac files is taken as an album and
+       not looked into any further. Only the newest 'limit' albums are kept,
+       in a heap. results() can be called while the scan is still going.'''
+
+    threads = 8
+
+    def __init__(self, flac_albums_dir, limit):
+        self.root = flac_albums_dir
+        self.limit = limit
+        # (mtime, path) of the newest albums found so far, oldest on top
+        self.heap = []
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.finished = threading.Event()
+        self.stopped = False
+        self.start = time.perf_counter()
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._submit(flac_albums_dir, None)
+
+    def results(self) -> list:
+        '''Returns the albums found so far, most recently modified first.'''
+
+        with self.lock:
+            return [Path(x) for _, x in sorted(self.heap, reverse=True)]
+
+    def wait(self, timeout=None) -> bool:
+        '''Waits for the scan to finish, returns False if it didn't within
+           'timeout' seconds.'''
+
+        return self.finished.wait(timeout)
+
+    def stop(self) -> None:
+        '''Stops scanning, folders that are being listed are finished.'''
+
+        self.stopped = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, path, mtime) -> None:
+        with self.lock:
+            if self.stopped:
+                return
+            self.pending += 1
+            try:
+                self.executor.submit(self._scan, path, mtime)
+            except RuntimeError:
+                # stopped in the meantime
+                self.pending -= 1
+
+    def _scan(self, path, mtime) -> None:
+        try:
+            if not self.stopped:
+                self._scan_dir(path, mtime)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                if not self.pending:
+                    metrics.add([{"album": None, "song": None,
+                                  "stage": "scan",
+                                  "seconds": time.perf_counter() - self.start,
+                                  "bytes_read": 0, "bytes_written": 0,
+                                  "subprocesses": 0}])
+                    # nothing can be submitted anymore, this lets the
+                    # threads end once this last folder is done
+                    self.executor.shutdown(wait=False)
+                    self.finished.set()
+
+    def _scan_dir(self, path, mtime) -> None:
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry)
+                    elif entry.name.endswith(".flac") and mtime is not None:
+                        # flac_albums_dir itself (without an mtime) is never
+                        # an album
+                        self._add(path, mtime)
+                        return
+        except OSError:
+            # unreadable or removed since its parent was listed
+            return
+        for entry in subdirs:
+            try:
+                subdir_mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+            self._submit(Path(entry.path), subdir_mtime)
+
+    def _add(self, path, mtime) -> None:
+        with self.lock:
+            if len(self.heap) < self.limit:
+                heapq.heappush(self.heap, (mtime, str(path)))
+            elif (mtime, str(path)) > self.heap[0]:
+                heapq.heapreplace(self.heap, (mtime, str(path)))
+
+
+class SyncState:
+    '''Remembers every file flac2lib has converted: the flac it came from
+       (with its size, mtime and audio md5 at the time), the tags written
+       and the settings used, stored in cache_dir/sync_state.json. This is
+       what the sync mode compares the library against, and with the md5 it
+       doubles as a catalogue of converted audio for find_output. The
+       loudness measured for ReplayGain is kept by the md5 as well, along
+       with the ReplayGain tags written into every file.'''
+
+    version = 1
+
+    def __init__(self, state_path):
+        self.path = state_path
+        self.outputs = {}
+        self.loudness = {}
+        # (md5, dst_format, ffmpeg_params) -> outputs, built when first used
+        self.catalogue = None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data["version"] == self.version:
+                self.outputs = data["outputs"]
+                self.loudness = data.get("loudness", {})
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self) -> None:
+        write_json(self.path, {"version": self.version,
+                               "outputs": self.outputs,
+                               "loudness": self.loudness})
+
+    def record(self, album, result) -> None:
+        '''Stores every output of a converted song. Files that were skipped
+           because they already existed are only adopted if they aren't known
+           yet, so a changed source is still noticed by the next sync. They
+           are recorded with the tags actually in them, if those differ from
+           the flac's, the next diff finds them outdated.'''
+
+        for output in result["outputs"]:
+            key = str(output["dst"])
+            if output["status"] == "skipped" and key in self.outputs:
+                continue
+            target = album.targets[output["target"]]
+            self._uncatalogue(key)
+            old_record = self.outputs.get(key, {})
+            self.outputs[key] = {"src": str(result["song"]),
+                                 "flac_path": str(album.flac_path),
+                                 "dst_path": str(target.dst_path),
+                                 "dst_format": target.dst_format,
+                                 "ffmpeg_params": target.ffmpeg_params,
+                                 "is_compilation": album.is_compilation,
+                                 **result["source"]}
+            if ("tags" in output
+                    and not tags_match(output["tags"],
+                                       result["source"]["tags"])):
+                self.outputs[key]["tags"] = output["tags"]
+                # makes diff look at the flac instead of trusting its mtime
+                self.outputs[key]["mtime"] = None
+            if (output["status"] == "retagged"
+                    and "replaygain" in old_record):
+                # update_song_tags kept them in the file
+                self.outputs[key]["replaygain"] = old_record["replaygain"]
+            if self.catalogue is not None:
+                self.catalogue.setdefault(self._catalogue_key(key),
+                                          []).append(key)
+
+    def diff(self, flac_paths=None) -> tuple:
+        '''Compares every recorded file with its source, or only the ones
+           converted from the album folders in flac_paths. Returns a list of
+           (dst, record, reason) for files that need to be converted again
+           and a list of (dst, record) for files whose source is gone.
+           Sources that were only touched have their record updated.'''
+
+        outdated = []
+        orphaned = []
+        for dst, record in self.outputs.items():
+            if (flac_paths is not None
+                    and record["flac_path"] not in flac_paths):
+                continue
+            src = Path(record["src"])
+            try:
+                stat = src.stat()
+            except FileNotFoundError:
+                orphaned.append((dst, record))
+                continue
+            if not Path(dst).exists():
+                outdated.append((dst, record, "output missing"))
+                continue
+            if (stat.st_size == record["size"]
+                    and stat.st_mtime == record["mtime"]):
+                continue
+
+            # size and mtime are only a hint, the md5 of the decoded audio
+            # and the tags tell what actually changed
+            info = read_flac_metadata(src)
+            tags_ = info['TAG']
+            if record["is_compilation"]:
+                tags_['compilation'] = '1'
+            if info['md5'] is None or info['md5'] != record["md5"]:
+                outdated.append((dst, record, "audio changed"))
+            elif tags_ != record["tags"]:
+                outdated.append((dst, record, "tags changed"))
+            else:
+                record["size"] = stat.st_size
+                record["mtime"] = stat.st_mtime
+        return outdated, orphaned
+
+    def forget(self, dst) -> None:
+        self._uncatalogue(dst)
+        del self.outputs[dst]
+
+    def find_output(self, md5, dst_format, ffmpeg_params, exclude=None):
+        '''Returns (path, tags) of an existing file converted from audio with
+           the given STREAMINFO md5 into dst_format with ffmpeg_params, other
+           than 'exclude', or None if there is none.'''
+
+        if self.catalogue is None:
+            self.catalogue = {}
+            for dst in self.outputs:
+                self.catalogue.setdefault(self._catalogue_key(dst),
+                                          []).append(dst)
+        for dst in self.catalogue.get((md5, dst_format, ffmpeg_params), []):
+            if dst != exclude and Path(dst).exists():
+                record = self.outputs[dst]
+                # ReplayGain tags of another album mustn't be linked along
+                return dst, {**record["tags"], **record.get("replaygain", {})}
+        return None
+
+    def album_songs(self, album) -> dict:
+        '''Returns {flac path: md5} of the songs converted before into the
+           album's main destination folder.'''
+
+        return {Path(x["src"]): x["md5"] for x in self.outputs.values()
+                if x["flac_path"] == str(album.flac_path)
+                and x["dst_path"] == str(album.dst_path)}
+
+    def _catalogue_key(self, dst) -> tuple:
+        record = self.outputs[dst]
+        return record["md5"], record["dst_format"], record["ffmpeg_params"]
+
+    def _uncatalogue(self, dst) -> None:
+        if self.catalogue is None or dst not in self.outputs:
+            return
+        outputs = self.catalogue.get(self._catalogue_key(dst), [])
+        if dst in outputs:
+            outputs.remove(dst)
+
+
+class Journal:
+    '''Keeps the queue and the songs that are already converted on disk in
+       cache_dir/journal.json while converting, so that a run that got
+       interrupted can be continued with --resume without asking anything
+       again or converting the finished songs again. Songs finish in worker
+       threads of the pipeline, hence the lock.
+
+       The file holds one json object per line: the version first, then
+       every queued album and every finished song in the order they came,
+       so a finished song only appends a short line instead of writing the
+       whole queue again.'''
+
+    version = 2
+
+    def __init__(self, journal_path):
+        self.path = journal_path
+        self.albums = []
+        self.finished = set()
+        self.lock = threading.Lock()
+        # the journal of an earlier run is replaced on the first write
+        self.created = False
+        self.removed = False
+
+    @classmethod
+    def load(cls, journal_path):
+        '''Returns the journal left by an interrupted run or None.'''
+
+        journal = cls(journal_path)
+        try:
+            with open(journal_path) as f:
+                lines = f.read().splitlines()
+            if json.loads(lines[0])["version"] != cls.version:
+                return None
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a run killed in the middle of writing
+                    break
+                if "album" in entry:
+                    journal.albums.append(
+                        AlbumToProcess.from_dict(entry["album"]))
+                else:
+                    journal.finished.add(tuple(entry["finished"]))
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+        journal.created = True
+        return journal
+
+    def _append(self, entry) -> None:
+        if self.removed:
+            # a song's callback may only run after the run is over
+            return
+        if not self.created:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "w") as f:
+                f.write(json.dumps({"version": self.version}) + "\n")
+            self.created = True
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def add_album(self, album) -> int:
+        '''Adds the album unless it's already in the journal, returns its
+           number.'''
+
+        with self.lock:
+            if album not in self.albums:
+                self.albums.append(album)
+                self._append({"album": album.to_dict()})
+            return self.albums.index(album)
+
+    def song_finished(self, album_nr, song_flac) -> None:
+        with self.lock:
+            self.finished.add((album_nr, str(song_flac)))
+            self._append({"finished": [album_nr, str(song_flac)]})
+
+    def remaining_songs(self, album_nr) -> list:
+        return [x for x in self.albums[album_nr].picks_paths
+                if (album_nr, str(x)) not in self.finished]
+
+    def remove(self) -> None:
+        with self.lock:
+            self.removed = True
+            self.path.unlink(missing_ok=True)
+
+
+class InotifyWatcher:
+    '''Waits for changes inside the watched folders with Linux's inotify,
+       called through ctypes. Raises OSError where inotify isn't available
+       or the kernel runs out of watches.'''
+
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    IN_IGNORED = 0x8000
+
+    def __init__(self):
+        import ctypes.util
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this system")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.paths = set()
+
+    def watch(self, paths) -> None:
+        '''Starts watching the folders that aren't watched yet.'''
+
+        for path in paths:
+            if path in self.paths:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                             self.mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "out of inotify watches, see "
+                                  + "fs.inotify.max_user_watches")
+                # the folder is already gone again
+                continue
+            self.watches[wd] = path
+            self.paths.add(path)
+
+    def wait(self, timeout) -> set:
+        '''Returns the folders in which something changed, or an empty set
+           if nothing did within 'timeout' seconds.'''
+
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                # struct inotify_event, followed by 'length' bytes of name
+                wd, mask, _, length = struct.unpack_from("iIII", data,
+                                                         offset)
+                offset += 16 + length
+                path = self.watches.get(wd)
+                if path is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    # the folder was removed, so was its watch
+                    del self.watches[wd]
+                    self.paths.discard(path)
+                    continue
+                changed.add(path)
+        return changed
+
+
+class PollingWatcher:
+    '''Stands in for InotifyWatcher by just sleeping, wait() returns None
+       meaning that anything might have changed.'''
+
+    def watch(self, paths) -> None:
+        pass
+
+    def wait(self, timeout) -> None:
+        time.sleep(timeout)
+        return None
+
+
+class Metrics:
+    '''Collects how long each stage (scan, probe, decode, encode, transcode,
+       retag, cover_art) took along with the bytes read and written and the
+       subprocesses spawned. Every stage run is a row tagged with its album
+       and song, so the rows can be summed up per song, album or stage.
+       Rows are only kept if 'enabled' is set (by --metrics or --profile),
+       a long --watch run would collect them forever otherwise.'''
+
+    fields = ["album", "song", "stage", "seconds", "bytes_read",
+              "bytes_written", "subprocesses"]
+
+    def __init__(self, enabled=True):
+        self.rows = []
+        self.enabled = enabled
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, album=None, song=None):
+        '''Times the block inside, which can fill in the byte and subprocess
+           counts of the yielded row.'''
+
+        row = {"album": album, "song": song, "stage": name, "seconds": 0.0,
+               "bytes_read": 0, "bytes_written": 0, "subprocesses": 0}
+        start = time.perf_counter()
+        try:
+            yield row
+        finally:
+            row["seconds"] = time.perf_counter() - start
+            self.add([row])
+
+    def add(self, rows) -> None:
+        '''Keeps the rows, e.g. the ones a worker process sent back.'''
+
+        if self.enabled:
+            self.rows.extend(rows)
+
+    def take(self, mark, album, song) -> list:
+        '''Removes the rows collected since mark (a previous length of
+           rows), tags them with the album and song and returns them.'''
+
+        rows = self.rows[mark:]
+        del self.rows[mark:]
+        for row in rows:
+            row["album"] = str(album.dst_path)
+            row["song"] = str(song)
+        return rows
+
+    def totals(self, key) -> dict:
+        '''Sums up the rows by the given field, ignoring rows without it.'''
+
+        totals = {}
+        for row in self.rows:
+            if row[key] is None:
+                continue
+            total = totals.setdefault(row[key], {
+                "count": 0, "seconds": 0.0, "bytes_read": 0,
+                "bytes_written": 0, "subprocesses": 0})
+            total["count"] += 1
+            for field in ["seconds", "bytes_read", "bytes_written",
+                          "subprocesses"]:
+                total[field] += row[field]
+        return totals
+
+    def write(self, metrics_path) -> None:
+        '''Writes every row into a csv file, or the rows together with
+           the totals per stage and album into a json file.'''
+
+        metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        if metrics_path.suffix == ".csv":
+            with open(metrics_path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=self.fields)
+                writer.writeheader()
+                writer.writerows(self.rows)
+        else:
+            write_json(metrics_path, {
+                "wall_seconds": time.perf_counter() - self.start,
+                "stages": self.totals("stage"),
+                "albums": self.totals("album"), "rows": self.rows})
+
+    def print_profile(self) -> None:
+        print("\n\n--- Profile ---\n")
+        print(f"{'stage':<12}{'count':>8}{'seconds':>12}{'read MB':>12}"
+              + f"{'written MB':>12}{'processes':>11}")
+        for name, total in sorted(self.totals("stage").items()):
+            print(f"{name:<12}{total['count']:>8}{total['seconds']:>12.2f}"
+                  + f"{total['bytes_read'] / 1e6:>12.1f}"
+                  + f"{total['bytes_written'] / 1e6:>12.1f}"
+                  + f"{total['subprocesses']:>11}")
+        print()
+        for name, total in self.totals("album").items():
+            print(f"{total['seconds']:>10.2f}s  {name}")
+        print(f"\nTotal run time: {time.perf_counter() - self.start:.2f}s")
+
+
+class Throttle:
+    '''Keeps the bytes passed to wait() under 'rate' bytes per second by
+       sleeping whenever they got ahead of it. The time until which the
+       bytes so far are paid for is a multiprocessing.Value, so a Throttle
+       handed to the worker processes (see init_worker) is shared by all of
+       them: with one song left, that song gets the whole rate.'''
+
+    def __init__(self, rate):
+        import multiprocessing
+        self.rate = rate
+        self.paid_until = multiprocessing.Value("d", 0.0)
+
+    def wait(self, nbytes) -> None:
+        with self.paid_until.get_lock():
+            # CLOCK_MONOTONIC is the same in every process
+            now = time.monotonic()
+            # time spent idle doesn't allow a burst later
+            start = max(self.paid_until.value, now)
+            self.paid_until.value = start + nbytes / self.rate
+            ahead = self.paid_until.value - now
+        if ahead > 0:
+            time.sleep(ahead)
 
 
 queue = []
+metrics = Metrics()
+# bandwidth limits shared by the worker processes, set up by init_worker
+read_throttle = None
+write_throttle = None
+CHUNK_SIZE = 1024 * 1024
+# the ioctl behind cp --reflink, from linux/fs.h
+FICLONE = 0x40049409
+# encoders AudioSegment.export picks for some formats (its DEFAULT_CODECS)
+DEFAULT_CODECS = {"ogg": "libvorbis"}
+# LUFS, what ReplayGain 2.0 adjusts every song to
+REPLAYGAIN_REFERENCE = -18.0
+# settings of config.yaml that have no default, see read_config
+REQUIRED_SETTINGS = ["flac_albums_dir", "dst_albums_dir", "entire", "latest",
+                     "get_cover_art", "dir_name_prompts",
+                     "num_albums_to_show", "default_cover_art_name",
+                     "cover_art_suffixes", "destination_format",
+                     "ffmpeg_params"]
+# bumped whenever read_config starts storing the settings differently
+CONFIG_CACHE_VERSION = 1
 
 
 def main():
@@ -31,6 +783,65 @@ def main():
        they're done with choosing albums, then proceeds to convert all the
        albums in the queue.'''
 
+    args = get_arg_parser().parse_args()
+
+    cfg = parse_args_and_config(args)
+    if cfg["library_index"]:
+        cfg["library"] = LibraryIndex(cfg["flac_albums_dir"],
+                                      cfg["cache_dir"] / "library_index.json")
+    else:
+        cfg["library"] = None
+
+    state = SyncState(cfg["cache_dir"] / "sync_state.json")
+    metrics.enabled = cfg["metrics_file"] is not None or cfg["profile"]
+
+    # with a manifest, stdout only gets the json summary (see run_manifest)
+    # so scripts can parse it, everything else goes to stderr
+    summary_file = sys.stdout
+    if cfg["manifest"] is not None:
+        sys.stdout = sys.stderr
+
+    print("\n----- flac2lib.py by PokerFacowaty -----")
+    print("https://github.com/PokerFacowaty/flac2lib")
+
+    journal_path = cfg["cache_dir"] / "journal.json"
+    if journal_path.exists() and not cfg["resume"]:
+        print("\nThe last run got interrupted, use --resume to continue it."
+              + " Queueing new albums now replaces it.")
+
+    exit_code = 0
+    if cfg["resume"]:
+        exit_code = resume_queue(cfg, state, journal_path)
+    elif cfg["manifest"] is not None:
+        exit_code = run_manifest(cfg, state, Journal(journal_path),
+                                 summary_file)
+    elif cfg["sync"] or cfg["retag"]:
+        sync_library(cfg, state)
+    elif cfg["watch"]:
+        watch_library(cfg, state)
+    else:
+        # albums start converting in the background as soon as they're queued
+        pipeline = ConversionPipeline(cfg["jobs"], state,
+                                      Journal(journal_path), cfg["limits"],
+                                      cfg["reuse_outputs"])
+        while process_album(cfg, pipeline):
+            # process_album returns True or False depending on the answer to
+            # the question whether the user wants to add another album
+            continue
+        pipeline.finish()
+
+    if cfg["library"] is not None:
+        cfg["library"].flush()
+
+    if cfg["metrics_file"] is not None:
+        metrics.write(cfg["metrics_file"])
+    if cfg["profile"]:
+        metrics.print_profile()
+    if exit_code:
+        sys.exit(exit_code)
+
+
+def get_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default=None,
                         help="point to a specific yaml config file")
@@ -53,20 +864,42 @@ def main():
     parser.add_argument("--not-compilation", action="store_true",
                         help="mark the album(s) as not compilation(s) and skip"
                         + "the prompt")
-    args = parser.parse_args()
-
-    cfg = parse_args_and_config(args)
-
-    print("\n----- flac2lib.py by PokerFacowaty -----")
-    print("https://github.com/PokerFacowaty/flac2lib")
-
-    while process_album(cfg):
-        # process_album returns True or False depending on the answer to the
-        # question whether the user wants to add another album
-        continue
-
-    for album in queue:
-        convert_songs(album)
+    parser.add_argument("--direct-transcode", action="store_true",
+                        default=None, help="let ffmpeg read the flac files"
+                        + " directly instead of decoding them with pydub")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="continue converting the queue of a run that got"
+                        + " interrupted")
+    parser.add_argument("-m", "--manifest", default=None, type=str,
+                        help="convert all the albums listed in a yaml or json"
+                        + " manifest file without any prompts")
+    parser.add_argument("--summary", default=None, type=str,
+                        help="write the json summary of a manifest run into"
+                        + " this file instead of printing it")
+    parser.add_argument("--sync", action="store_true",
+                        help="convert the songs whose flac files changed since"
+                        + " they were converted instead of choosing albums")
+    parser.add_argument("--retag", action="store_true",
+                        help="like --sync, but only rewrite the tags of songs"
+                        + " whose flac tags changed, without converting")
+    parser.add_argument("--prune", action="store_true",
+                        help="when syncing, delete converted songs whose flac"
+                        + " files no longer exist")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="when syncing, only show what would be done")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="keep running and convert albums as soon as they"
+                        + " appear in flac_albums_dir, without any prompts")
+    parser.add_argument("--metrics", default=None, type=str,
+                        help="write timings of every stage into a json or csv"
+                        + " file")
+    parser.add_argument("--profile", action="store_true",
+                        help="print a table of the time spent in every stage"
+                        + " at the end")
+    parser.add_argument("-j", "--jobs", default=None, type=int,
+                        help="number of songs converted in parallel, 0 uses"
+                        + " all CPU cores")
+    return parser
 
 
 def parse_args_and_config(args) -> dict:
@@ -79,7 +912,7 @@ def parse_args_and_config(args) -> dict:
         config_file = 'config.yaml'
     else:
         config_file = args.config
-    yaml_config = yaml.safe_load(open(config_file))
+    yaml_config = read_config(Path(config_file))
 
     if args.source is None:
         cfg["flac_album_path"] = None
@@ -123,91 +956,221 @@ def parse_args_and_config(args) -> dict:
     cfg["num_albums_to_show"] = yaml_config["num_albums_to_show"]
     cfg["default_cover_art_name"] = yaml_config["default_cover_art_name"]
     cfg["cover_art_suffixes"] = yaml_config["cover_art_suffixes"]
+    cfg["hardlink_cover_art"] = yaml_config.get("hardlink_cover_art", False)
     cfg["dst_format"] = yaml_config["destination_format"]
     cfg["ffmpeg_params"] = yaml_config["ffmpeg_params"]
+    cfg["extra_targets"] = [{"dst_format": x["destination_format"],
+                             "ffmpeg_params": x["ffmpeg_params"],
+                             "dst_albums_dir": Path(x["dst_albums_dir"])}
+                            for x in yaml_config.get("extra_targets") or []]
+    cfg["library_index"] = yaml_config.get("library_index", True)
+    cfg["replaygain"] = yaml_config.get("replaygain", False)
+    cfg["reuse_outputs"] = yaml_config.get("reuse_outputs", "copy")
+    # relative to the config file, not to wherever the script is started from
+    cfg["cache_dir"] = (Path(config_file).parent
+                        / yaml_config.get("cache_dir", ".flac2lib"))
+
+    if args.direct_transcode is None:
+        cfg["direct_transcode"] = yaml_config.get("direct_transcode", False)
+    else:
+        cfg["direct_transcode"] = args.direct_transcode
+
+    cfg["resume"] = args.resume
+    cfg["manifest"] = None if args.manifest is None else Path(args.manifest)
+    cfg["summary"] = None if args.summary is None else Path(args.summary)
+    cfg["metrics_file"] = None if args.metrics is None else Path(args.metrics)
+    cfg["profile"] = args.profile
+    cfg["sync"] = args.sync
+    cfg["retag"] = args.retag
+    cfg["prune"] = args.prune
+    cfg["dry_run"] = args.dry_run
+    cfg["watch"] = args.watch
+    cfg["watch_interval"] = yaml_config.get("watch_interval", 10)
+    cfg["watch_settle_time"] = yaml_config.get("watch_settle_time", 60)
+
+    if args.jobs is None:
+        cfg["jobs"] = yaml_config.get("jobs", 1)
+    else:
+        cfg["jobs"] = args.jobs
+    if cfg["jobs"] < 1:
+        cfg["jobs"] = os.cpu_count() or 1
+
+    # 0 (or leaving them out) means no limit for all of these
+    cfg["limits"] = {"max_encoders": yaml_config.get("max_encoders", 0),
+                     "max_job_memory": yaml_config.get("max_job_memory", 0),
+                     "max_read_speed": yaml_config.get("max_read_speed", 0),
+                     "max_write_speed": yaml_config.get("max_write_speed", 0),
+                     "nice": yaml_config.get("nice", 0),
+                     "low_io_priority": yaml_config.get("low_io_priority",
+                                                        False),
+                     "max_load": yaml_config.get("max_load", 0)}
 
     return cfg
 
 
-def process_album(cfg) -> bool:
+def read_config(config_file) -> dict:
+    '''Returns the settings of the yaml config file after making sure none of
+       the required ones is missing. Loading yaml takes longer than the rest
+       of starting up, so the checked settings are also written as json next
+       to the config file (.config.yaml.json for config.yaml) and read from
+       there as long as the config file keeps its size and modification
+       time.'''
+
+    stat = config_file.stat()
+    cache_path = config_file.with_name(f".{config_file.name}.json")
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if (cached["version"] == CONFIG_CACHE_VERSION
+                and cached["size"] == stat.st_size
+                and cached["mtime"] == stat.st_mtime_ns):
+            return cached["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml
+    with open(config_file) as f:
+        yaml_config = yaml.safe_load(f)
+    if not isinstance(yaml_config, dict):
+        sys.exit(f"{config_file} doesn't contain any settings")
+    missing = [x for x in REQUIRED_SETTINGS if x not in yaml_config]
+    if missing:
+        sys.exit(f"{config_file} is missing these settings: "
+                 + ", ".join(missing))
+
+    try:
+        write_json(cache_path, {"version": CONFIG_CACHE_VERSION,
+                                "size": stat.st_size,
+                                "mtime": stat.st_mtime_ns,
+                                "config": yaml_config})
+    except (OSError, TypeError, ValueError):
+        # a read-only folder or a value json can't hold (like a date), the
+        # config just gets parsed every time
+        pass
+    return yaml_config
+
+
+def process_album(cfg, pipeline=None) -> bool:
     '''Gets all the info that is needed about the album and stores it in an
-       AlbumToProcess object inside the queue list.'''
+       AlbumToProcess object inside the queue list. The album is also handed
+       to the pipeline right away if one is given, so it gets converted
+       while the next album is being chosen.'''
 
     single_album = False
     if cfg["flac_album_path"] is None:
         cfg["flac_album_path"] = get_flac_album_path(cfg["flac_albums_dir"],
                                                      cfg["num_albums_to_show"],
-                                                     cfg["latest"])
+                                                     cfg["latest"],
+                                                     cfg["library"])
     else:
         single_album = True
 
-    if cfg["is_compilation"] is None:
-        cfg["is_compilation"] = ask_if_compilation()
+    is_compilation = cfg["is_compilation"]
+    if is_compilation is None:
+        is_compilation = ask_if_compilation()
 
-    cfg["song_picks_paths"] = pick_songs(cfg["flac_album_path"], cfg["entire"])
+    cfg["song_picks_paths"] = pick_songs(cfg["flac_album_path"], cfg["entire"],
+                                         cfg["library"])
 
     if cfg["dst_album_path"] is None:
         (cfg["artist_name"],
          cfg["album_name"],
          cfg["dst_album_path"]) = get_dst_album_path(cfg["song_picks_paths"],
                                                      cfg["dst_albums_dir"],
-                                                     cfg["dir_prompts"])
+                                                     cfg["dir_prompts"],
+                                                     cfg["library"])
     else:
         single_album = True
 
     if cfg["cover_art"]:
         get_cover_art(cfg)
 
-    queue.append(AlbumToProcess(cfg["dst_album_path"], cfg["song_picks_paths"],
-                                cfg["flac_album_path"], cfg["ffmpeg_params"],
-                                cfg["dst_format"], cfg["is_compilation"]))
+    album = AlbumToProcess(cfg["dst_album_path"], cfg["song_picks_paths"],
+                           cfg["flac_album_path"], cfg["ffmpeg_params"],
+                           cfg["dst_format"], is_compilation,
+                           cfg["direct_transcode"],
+                           get_extra_targets(cfg, cfg["dst_album_path"]),
+                           cfg["replaygain"])
+    queue.append(album)
+    if pipeline is not None:
+        pipeline.submit(album)
 
     if single_album:
         return False
 
     while True:
+        if pipeline is not None:
+            pipeline.report()
         answer = input("\nWould you like to add more albums? [y/n]\n:")
         if answer.lower() == "y":
+            # these were picked for this album, the next one needs its own
+            cfg["flac_album_path"] = None
+            cfg["dst_album_path"] = None
             return True
         elif answer.lower() == "n":
             return False
 
 
-def get_flac_album_path(flac_albums_dir, num_albums_to_show, latest) -> Path:
+def get_flac_album_path(flac_albums_dir, num_albums_to_show, latest,
+                        library=None) -> Path:
     '''Fetches folders inside flac_albums_dir containing flac files (note that
        with multi-CD albums, each CD is treated as a separate album since that
        is the best way of dealing with those I thought of), sorts them
        by their modification time, takes user input on which one should be
        chosen; returns the first one without asking if 'latest' is set
-       to True'''
-
-    folders_with_flacs = []
-    for x in flac_albums_dir.rglob("*"):
-        if (x.suffix == ".flac"
-           and x.parent not in folders_with_flacs
-           and x.parent != flac_albums_dir):
-            folders_with_flacs.append(x.parent)
-
-    # sorts the albums by their modification time, most recent first
-    folder_paths_to_show = sorted(folders_with_flacs, key=lambda
-                                  x: x.lstat().st_mtime, reverse=True)
+       to True. Uses the library index instead of walking the whole
+       directory if one is given, otherwise an AlbumScanner, showing the
+       list while it's still scanning. 'm' shows num_albums_to_show more
+       albums (scanning again for that many) and 'r' shows the list again
+       with whatever was found in the meantime.'''
+
+    scanner = None
+    if library is not None:
+        with metrics.stage("scan"):
+            library.refresh()
+            all_folder_paths = library.albums()
+    else:
+        # the scanner adds its own "scan" row once it's done
+        scanner = AlbumScanner(flac_albums_dir,
+                               1 if latest else num_albums_to_show)
+        # small libraries are done before anyone could read the list
+        scanner.wait(None if latest else 0.5)
 
     if latest:
-        return folder_paths_to_show[0]
+        if scanner is not None:
+            return scanner.results()[0]
+        return all_folder_paths[0]
 
-    print("\n\n--- Albums ---\n")
-    rel_folder_paths_to_show = [x.relative_to(flac_albums_dir)
-                                for x in folder_paths_to_show]
+    print("\n\n--- Albums ---")
+    num_shown = num_albums_to_show
+    while True:
+        if scanner is None:
+            folder_paths_to_show = all_folder_paths[:num_shown]
+        else:
+            if scanner.limit < num_shown:
+                scanner.stop()
+                scanner = AlbumScanner(flac_albums_dir, num_shown)
+                scanner.wait(0.5)
+            folder_paths_to_show = scanner.results()
 
-    for i in range(min(len(folder_paths_to_show), num_albums_to_show)):
-        print(f"{i}: ", str(rel_folder_paths_to_show[i]))
+        print()
+        for i, folder_path in enumerate(folder_paths_to_show):
+            print(f"{i}: ", str(folder_path.relative_to(flac_albums_dir)))
+        if scanner is not None and not scanner.wait(0):
+            print("(still scanning, 'r' refreshes the list)")
 
-    while True:
-        answer = input("\nChoose the album\n:")
-        if (answer.isnumeric()
-           and int(answer) < (min(len(folder_paths_to_show),
-                                  num_albums_to_show))):
-            return folder_paths_to_show[int(answer)]
+        while True:
+            answer = input("\nChoose the album ('m' shows more)\n:")
+            if (answer.isnumeric()
+               and int(answer) < len(folder_paths_to_show)):
+                if scanner is not None:
+                    scanner.stop()
+                return folder_paths_to_show[int(answer)]
+            elif answer == "m":
+                num_shown += num_albums_to_show
+                break
+            elif answer == "r":
+                break
 
 
 def ask_if_compilation() -> bool:
@@ -222,12 +1185,16 @@ def ask_if_compilation() -> bool:
             return False
 
 
-def pick_songs(flac_album_path, entire) -> list:
+def pick_songs(flac_album_path, entire, library=None) -> list:
     '''Fetches all the flac files found in the album path, takes user input
        on which ones should be chosen and returns the paths for those. Returns
        all paths found if 'entire' is set to True.'''
 
-    all_flac_files_paths = sorted(list(flac_album_path.rglob("*.flac")))
+    all_flac_files_paths = None
+    if library is not None:
+        all_flac_files_paths = library.tracks(flac_album_path)
+    if all_flac_files_paths is None:
+        all_flac_files_paths = sorted(list(flac_album_path.rglob("*.flac")))
 
     if entire:
         song_picks = list(range(len(all_flac_files_paths)))
@@ -262,7 +1229,8 @@ def pick_songs(flac_album_path, entire) -> list:
     return [all_flac_files_paths[x] for x in song_picks]
 
 
-def get_dst_album_path(song_picks_paths, dst_albums_dir, dir_prompts):
+def get_dst_album_path(song_picks_paths, dst_albums_dir, dir_prompts,
+                       library=None):
     '''Proposes an artist/album combo for the destination dir and subdir names
        based on the flac's metadata. Takes confirmation or custom names as
        input. Asks if there is an additional folder needed (such as 'CD1' for
@@ -272,22 +1240,8 @@ def get_dst_album_path(song_picks_paths, dst_albums_dir, dir_prompts):
        a full destination folder path. Also returns artist_name and
        album_name since these are established in the process.'''
 
-    # This looping is so that it covers all possibilities of the spelling I
-    # could think of. 'TAG' and 'ARTIST' covered most cases initially, but then
-    # I came across an exception that would break everything.
-    artist_name = None
-    album_name = None
-    # Corrected the mistake of reading metadata from the file every loop
-    info = mediainfo(song_picks_paths[0])
-    for t in ['TAG', 'tag', 'Tag']:
-        for ar in ['ARTIST', 'artist', 'Artist']:
-            if (t in info and ar in info[t]):
-                artist_name = info.get(t, None)[ar]
-                break
-        for al in ['ALBUM', 'album', 'Album']:
-            if (t in info and al in info[t]):
-                album_name = info.get(t, None)[al]
-                break
+    artist_name, album_name = get_artist_and_album(song_picks_paths[0],
+                                                   library)
 
     if dir_prompts:
         print("\n\n--- Destination folder name ---\n")
@@ -353,6 +1307,186 @@ def get_dst_album_path(song_picks_paths, dst_albums_dir, dir_prompts):
     return artist_name, album_name, dst_album_path
 
 
+def get_artist_and_album(song_flac, library=None) -> tuple:
+    '''Returns the ARTIST and ALBUM tags of a flac file (None for tags that
+       are missing), from the library index if it has them.'''
+
+    # This looping is so that it covers all possibilities of the spelling I
+    # could think of. 'TAG' and 'ARTIST' covered most cases initially, but then
+    # I came across an exception that would break everything.
+    artist_name = None
+    album_name = None
+    # Corrected the mistake of reading metadata from the file every loop
+    info = None
+    if library is not None:
+        info = library.first_track_tags(song_flac)
+    if info is None:
+        info = read_flac_metadata(song_flac)
+    for t in ['TAG', 'tag', 'Tag']:
+        for ar in ['ARTIST', 'artist', 'Artist']:
+            if (t in info and ar in info[t]):
+                artist_name = info.get(t, None)[ar]
+                break
+        for al in ['ALBUM', 'album', 'Album']:
+            if (t in info and al in info[t]):
+                album_name = info.get(t, None)[al]
+                break
+    return artist_name, album_name
+
+
+def read_flac_metadata(flac_path) -> dict:
+    '''Reads the STREAMINFO and VORBIS_COMMENT blocks straight from the flac
+       file's header, which is much cheaper than spawning ffprobe through
+       mediainfo for every song. Returns a dict shaped like the one from
+       mediainfo: tags under 'TAG' spelled exactly like in the file (so
+       'ARTIST', 'artist' and 'Artist' stay distinct, repeated tags are joined
+       with ';' like ffprobe does), except the ones ffmpeg renames to its
+       generic names (see VORBIS_TAG_NAMES), plus 'duration' in seconds,
+       'sample_rate',
+       'channels', 'bits_per_sample', 'total_samples' and the audio 'md5'.
+       Falls back to mediainfo if the file isn't a flac it can parse.'''
+
+    info = {'TAG': {}, 'duration': 0.0, 'sample_rate': 0, 'channels': 0,
+            'bits_per_sample': 0, 'total_samples': 0, 'md5': None}
+    with metrics.stage("probe") as row:
+        try:
+            with open(flac_path, "rb") as f:
+                row["bytes_read"] = _read_flac_header(f, info)
+        except (OSError, ValueError, struct.error, UnicodeDecodeError):
+            row["subprocesses"] = 1
+            return _mediainfo_fallback(flac_path)
+    return info
+
+
+def _read_flac_header(f, info) -> int:
+    marker = f.read(4)
+    if marker[:3] == b"ID3":
+        # some taggers put an ID3v2 tag in front of the flac stream
+        header = marker[3:] + f.read(6)
+        size = 0
+        for byte in header[-4:]:
+            size = (size << 7) | (byte & 0x7f)
+        if header[2] & 0x10:
+            size += 10
+        f.seek(10 + size)
+        marker = f.read(4)
+    if marker != b"fLaC":
+        raise ValueError("not a flac stream")
+
+    skipped = 0
+    last = False
+    while not last:
+        block_header = f.read(4)
+        if len(block_header) < 4:
+            raise ValueError("truncated metadata")
+        last = bool(block_header[0] & 0x80)
+        block_type = block_header[0] & 0x7f
+        length = int.from_bytes(block_header[1:], "big")
+
+        if block_type == 0:
+            _parse_streaminfo(f.read(length), info)
+        elif block_type == 4:
+            _parse_vorbis_comment(f.read(length), info['TAG'])
+        else:
+            # pictures can be megabytes, never read them
+            f.seek(length, 1)
+            skipped += length
+    # the number of bytes actually read
+    return f.tell() - skipped
+
+
+def _parse_streaminfo(data, info) -> None:
+    if len(data) < 34:
+        raise ValueError("truncated STREAMINFO")
+    # sample rate (20 bits), channels - 1 (3), bits per sample - 1 (5)
+    # and the total samples (36) are packed into bytes 10-17
+    packed = int.from_bytes(data[10:18], "big")
+    info['sample_rate'] = packed >> 44
+    info['channels'] = ((packed >> 41) & 0x07) + 1
+    info['bits_per_sample'] = ((packed >> 36) & 0x1f) + 1
+    info['total_samples'] = packed & 0xfffffffff
+    if info['sample_rate']:
+        info['duration'] = info['total_samples'] / info['sample_rate']
+    # an all-zero md5 means the encoder didn't compute one
+    if any(data[18:34]):
+        info['md5'] = data[18:34].hex()
+
+
+# vorbis comments ffmpeg's flac demuxer reports under its generic names,
+# only those are mapped to the right frames by e.g. the ID3 muxer (TRCK,
+# TPOS, TPE2, COMM instead of TXXX:TRACKNUMBER and the like)
+VORBIS_TAG_NAMES = {"ALBUMARTIST": "album_artist", "TRACKNUMBER": "track",
+                    "DISCNUMBER": "disc", "DESCRIPTION": "comment"}
+
+
+def _parse_vorbis_comment(data, tags) -> None:
+    # unlike the rest of flac, vorbis comments are little-endian
+    vendor_length, = struct.unpack_from("<I", data, 0)
+    offset = 4 + vendor_length
+    count, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    for _ in range(count):
+        length, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        comment = data[offset:offset + length].decode("utf-8")
+        offset += length
+        key, sep, value = comment.partition("=")
+        if not sep:
+            continue
+        key = VORBIS_TAG_NAMES.get(key.upper(), key)
+        if key in tags:
+            tags[key] += ";" + value
+        else:
+            tags[key] = value
+
+
+def read_output_tags(path) -> dict:
+    '''Returns the tags of a converted file as ffprobe reports them (through
+       pydub's mediainfo), for files flac2lib finds already there.'''
+
+    from pydub.utils import mediainfo
+    with metrics.stage("probe") as row:
+        tags_ = mediainfo(path).get('TAG', {})
+        row["subprocesses"] = 1
+    return tags_
+
+
+def tags_match(output_tags, tags_) -> bool:
+    '''Tells whether the tags read from a converted file (see
+       read_output_tags) are the ones flac2lib would write from tags_,
+       ignoring the case of the keys and what the encoder adds itself.'''
+
+    def normalize(tags_):
+        normalized = {}
+        for key, value in tags_.items():
+            normalized[key.lower()] = str(value)
+        normalized.pop("encoder", None)
+        return normalized
+
+    return normalize(output_tags) == normalize(tags_)
+
+
+def _mediainfo_fallback(path) -> dict:
+    from pydub.utils import mediainfo
+    probed = mediainfo(path)
+
+    def number(key, type_):
+        # ffprobe reports missing values as 'N/A'
+        try:
+            return type_(probed.get(key))
+        except (TypeError, ValueError):
+            return type_(0)
+
+    info = {'TAG': probed.get('TAG', {}),
+            'duration': number('duration', float),
+            'sample_rate': number('sample_rate', int),
+            'channels': number('channels', int),
+            'bits_per_sample': number('bits_per_raw_sample', int),
+            'total_samples': 0, 'md5': None}
+    info['total_samples'] = int(info['duration'] * info['sample_rate'])
+    return info
+
+
 def get_cover_art(cfg) -> None:
     '''Fetches all images with proper suffixes found in the flac_album_path.
        Offers options to choose a main cover art file (copied directly into the
@@ -361,19 +1495,20 @@ def get_cover_art(cfg) -> None:
        file from covers.musichoarders.xyz. Checks for existing files
        before copying.'''
 
-    all_images_paths = []
-    for suffix in cfg["cover_art_suffixes"]:
-        all_images_paths.extend(list(cfg["flac_album_path"].rglob(
-                                     f"*.{suffix}")))
+    with metrics.stage("cover_art", album=str(cfg["dst_album_path"])):
+        all_images_paths, image_sizes_ = list_cover_art(
+            cfg["flac_album_path"], cfg["cover_art_suffixes"])
 
     print("\n\n--- Cover Art ---\n")
     if all_images_paths:
-        for nr, (fpath, fname) in enumerate([(x, x.relative_to(
-                                                    cfg["flac_album_path"]))
-                                             for x in all_images_paths]):
-            img = cv2.imread(str(fpath))
-            h, w, _ = img.shape
-            print(nr, ": ", fname, f" ({w}x{h})")
+        for nr, (fname, size) in enumerate([(x.relative_to(
+                                                cfg["flac_album_path"]), y)
+                                            for x, y in zip(all_images_paths,
+                                                            image_sizes_)]):
+            if size is not None:
+                print(nr, ": ", fname, f" ({size[0]}x{size[1]})")
+            else:
+                print(nr, ": ", fname, " (unknown size)")
     else:
         print("No cover art found. Would you like to download cover art from",
               "covers.musichoarders.xyz?\n[y] / [n]")
@@ -391,7 +1526,9 @@ def get_cover_art(cfg) -> None:
              + f"destination folder as \"{cfg['default_cover_art_name']}\"."
              + "\np<number> - preview the image \nc<number> - copy "
              + "an additional file directly without changing "
-             + "its name\nd - download main cover art from "
+             + "its name\na - copy all the cover art files that way"
+             + "\ns<number> - copy the whole folder the file is in (e.g. "
+             + "scans)\nd - download main cover art from "
              + "covers.musichoarders.xyz"
              + "\nq - finish copying cover art and proceed\n"
              + "h - see this prompt again\n")
@@ -400,6 +1537,9 @@ def get_cover_art(cfg) -> None:
     while True:
         answer = input(":")
         if answer[0] == "p":
+            # OpenCV is only imported once a preview is actually requested,
+            # it's slow to load and needs a display stack anyway
+            import cv2
             img = cv2.imread(str(all_images_paths[int(answer[1:])]))
             cv2.namedWindow("cover")
             cv2.imshow("cover", img)
@@ -407,26 +1547,41 @@ def get_cover_art(cfg) -> None:
             while cv2.getWindowProperty("cover", cv2.WND_PROP_VISIBLE) >= 1:
                 cv2.waitKey(100)
         elif answer[0] == "c":
-            misc_src = all_images_paths[int(answer[1:])]
-            misc_dest = (cfg["dst_album_path"]
-                         / misc_src.relative_to(cfg["flac_album_path"]))
-
-            if not misc_dest.exists():
-                misc_dest.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(misc_src, misc_dest)
+            misc_dest = copy_misc_cover_art(
+                [all_images_paths[int(answer[1:])]], cfg["flac_album_path"],
+                cfg["dst_album_path"], cfg["hardlink_cover_art"])
+            if misc_dest:
                 print("Misc cover art succesfully copied as "
-                      + f"{misc_dest}\n")
+                      + f"{misc_dest[0]}\n")
             else:
                 print("Misc cover art already copied, skipping...\n")
+        elif answer[0] == "a":
+            new_paths = copy_misc_cover_art(
+                all_images_paths, cfg["flac_album_path"],
+                cfg["dst_album_path"], cfg["hardlink_cover_art"])
+            print(f"{len(new_paths)} cover art files copied, "
+                  + f"{len(all_images_paths) - len(new_paths)} were already "
+                  + "there\n")
+        elif answer[0] == "s":
+            folder = all_images_paths[int(answer[1:])].parent
+            if folder == cfg["flac_album_path"]:
+                print("That image isn't in a subfolder, use 'a' to copy all "
+                      + "the cover art\n")
+                continue
+            # everything in the folder, not only images (e.g. PDF booklets)
+            src_paths = sorted(x for x in folder.rglob("*")
+                               if x.is_file() and x.suffix != ".flac")
+            new_paths = copy_misc_cover_art(
+                src_paths, cfg["flac_album_path"], cfg["dst_album_path"],
+                cfg["hardlink_cover_art"])
+            print(f"{len(new_paths)} files of {folder.name} copied, "
+                  + f"{len(src_paths) - len(new_paths)} were already there\n")
         elif answer.isnumeric():
-            main_src = all_images_paths[int(answer)]
-            main_dest = (cfg["dst_album_path"]
-                         / (cfg["default_cover_art_name"]
-                            + all_images_paths[int(answer)].suffix))
-
-            if not main_dest.exists():
-                cfg["dst_album_path"].mkdir(parents=True, exist_ok=True)
-                shutil.copy2(main_src, main_dest)
+            main_dest = copy_main_cover_art(all_images_paths[int(answer)],
+                                            cfg["dst_album_path"],
+                                            cfg["default_cover_art_name"],
+                                            cfg["hardlink_cover_art"])
+            if main_dest is not None:
                 print("Main cover art succesfully copied as "
                       + f"{main_dest.stem}\n")
             else:
@@ -449,6 +1604,151 @@ def get_cover_art(cfg) -> None:
     return
 
 
+def list_cover_art(flac_album_path, cover_art_suffixes) -> tuple:
+    '''Returns the paths of all images with the given suffixes inside the
+       album folder and their sizes as (width, height) or None.'''
+
+    all_images_paths = []
+    for suffix in cover_art_suffixes:
+        all_images_paths.extend(list(flac_album_path.rglob(f"*.{suffix}")))
+    return all_images_paths, [get_image_size(x) for x in all_images_paths]
+
+
+def copy_main_cover_art(main_src, dst_album_path, default_cover_art_name,
+                        link=False):
+    '''Copies main_src into the destination folder as default_cover_art_name
+       keeping its suffix (see transfer_image). Returns the new path or None
+       if it already existed.'''
+
+    main_dest = dst_album_path / (default_cover_art_name + main_src.suffix)
+    if main_dest.exists():
+        return None
+    dst_album_path.mkdir(parents=True, exist_ok=True)
+    with metrics.stage("cover_art", album=str(dst_album_path)) as row:
+        transfer_image(main_src, main_dest, link)
+        row["bytes_read"] = main_dest.stat().st_size
+        row["bytes_written"] = row["bytes_read"]
+    return main_dest
+
+
+def copy_misc_cover_art(src_paths, flac_album_path, dst_album_path,
+                        link=False) -> list:
+    '''Copies files from the album folder into the destination folder
+       keeping their paths relative to the album, skipping the ones that
+       already exist (see transfer_image). Returns the paths of the new
+       files.'''
+
+    new_paths = []
+    with metrics.stage("cover_art", album=str(dst_album_path)) as row:
+        for src in src_paths:
+            dst = dst_album_path / src.relative_to(flac_album_path)
+            if dst.exists():
+                continue
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            transfer_image(src, dst, link)
+            row["bytes_read"] += dst.stat().st_size
+            row["bytes_written"] += dst.stat().st_size
+            new_paths.append(dst)
+    return new_paths
+
+
+# sizes of the images copied during this run -> their destination paths
+copied_images = {}
+
+
+def transfer_image(src, dst, link=False) -> str:
+    '''Copies an image with transfer_file, unless the same image (the same
+       size and sha256) was already copied during this run, e.g. the same
+       scans in every CD folder, which are listed as separate albums. Then
+       it's transferred from the earlier copy at the destination instead:
+       hardlinked with 'link' set or reflinked where the filesystem can,
+       which saves writing it and the space it takes, otherwise copied.
+       Only images with the size of an earlier one are hashed, reading the
+       new image once and the earlier copy (at the destination, not its
+       source) once per run. Returns what transfer_file did.'''
+
+    size = src.stat().st_size
+    for earlier_dst in copied_images.get(size, []):
+        if (earlier_dst.exists()
+                and get_file_hash(earlier_dst) == get_file_hash(src)):
+            return transfer_file(earlier_dst, dst, link)
+    method = transfer_file(src, dst, link)
+    copied_images.setdefault(size, []).append(dst)
+    return method
+
+
+file_hashes = {}
+
+
+def get_file_hash(path) -> str:
+    '''Returns the sha256 of a file, remembered for the rest of the run.'''
+
+    if path not in file_hashes:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                sha256.update(chunk)
+        file_hashes[path] = sha256.hexdigest()
+    return file_hashes[path]
+
+
+def get_image_size(image_path):
+    '''Returns the (width, height) of a JPEG or PNG image read from its
+       SOF or IHDR header alone, without decoding the image. Other formats
+       fall back to decoding the image with OpenCV; returns None if that
+       isn't possible either.'''
+
+    try:
+        with open(image_path, "rb") as f:
+            size = _read_image_header_size(f)
+    except (OSError, struct.error):
+        size = None
+    if size is None:
+        try:
+            import cv2
+            h, w = cv2.imread(str(image_path)).shape[:2]
+            size = (w, h)
+        except (ImportError, AttributeError):
+            pass
+    return size
+
+
+def _read_image_header_size(f):
+    signature = f.read(8)
+    if signature == b"\x89PNG\r\n\x1a\n":
+        # the IHDR chunk always comes first: length, type, width, height
+        chunk = f.read(16)
+        if chunk[4:8] != b"IHDR":
+            return None
+        return struct.unpack(">II", chunk[8:16])
+
+    if signature[:2] != b"\xff\xd8":
+        return None
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        # 0xff bytes can be used as padding before a marker
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            # markers without a length field
+            continue
+        length, = struct.unpack(">H", f.read(2))
+        # SOF0-SOF15 except DHT (c4), JPG (c8) and DAC (cc)
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            h, w = struct.unpack(">xHH", f.read(5))
+            return w, h
+        f.seek(length - 2, 1)
+
+
 def download_cover_art(artist_name, album_name, dst_album_path,
                        default_cover_art_name) -> None:
     '''Prepares a query for covers.musichoaders.xyz by asking whether artist
@@ -475,6 +1775,8 @@ def download_cover_art(artist_name, album_name, dst_album_path,
         params['artist'] = artist
     params['album'] = album_name
 
+    from urllib.parse import urlencode
+    import webbrowser
     url = baseurl + "?" + urlencode(params)
     webbrowser.open(url)
 
@@ -486,43 +1788,1455 @@ def download_cover_art(artist_name, album_name, dst_album_path,
     dst_album_path.mkdir(parents=True, exist_ok=True)
     covert_art_file = (dst_album_path / (default_cover_art_name
                        + cover_art_link[cover_art_link.rfind("."):]))
+    from urllib.request import urlopen
     with urlopen(cover_art_link) as resp, open(covert_art_file, "wb+") as f:
         shutil.copyfileobj(resp, f)
 
     print(f"\nSuccesfully downloaded {covert_art_file.name}")
 
 
-def convert_songs(album) -> None:
-    '''Converts all flac files into dst_format preserving subdirs. Checks if
-       songs already exist. Makes subdirs if they don't exist.'''
+def write_json(path, data) -> None:
+    '''Writes data into a temporary file first and renames it over path, so
+       an interrupted run never leaves a half-written file behind.'''
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+    except BaseException:
+        # e.g. a value json can't hold, nothing should be left behind
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+
+def get_dst_song_path(album, song_flac, target=None) -> Path:
+    '''Constructs the destination path of a single song, preserving subdirs
+       of the flac album unless the destination folder already is the
+       subdir (like 'CD1' typed in at the destination prompt). Uses the
+       album's first target unless another one is given.'''
+
+    if target is None:
+        target = album.targets[0]
+    if (str(target.dst_path.name)
+            == str(song_flac.parent.relative_to(album.flac_path))):
+        return target.dst_path / (song_flac.stem + "." + target.dst_format)
+    return (target.dst_path
+            / song_flac.parent.relative_to(album.flac_path)
+            / (song_flac.stem + "." + target.dst_format))
+
+
+def get_extra_targets(cfg, dst_album_path) -> list:
+    '''Builds an OutputTarget for every entry of 'extra_targets', placing the
+       album at the same path relative to the entry's dst_albums_dir as it
+       has inside the main dst_albums_dir (or directly inside it if the
+       album isn't in the main dst_albums_dir).'''
+
+    if dst_album_path.is_relative_to(cfg["dst_albums_dir"]):
+        rel_album_path = dst_album_path.relative_to(cfg["dst_albums_dir"])
+    else:
+        rel_album_path = Path(dst_album_path.name)
+    return [OutputTarget(x["dst_albums_dir"] / rel_album_path,
+                         x["dst_format"], x["ffmpeg_params"])
+            for x in cfg["extra_targets"]]
+
+
+def read_source(album, song_flac) -> dict:
+    '''Reads what's needed to convert song_flac and to tell later whether it
+       has changed: its size, mtime and audio md5 plus the tags exactly as
+       they're written to the destination file.'''
+
+    stat = song_flac.stat()
+    info = read_flac_metadata(song_flac)
+    tags_ = info['TAG']
+    if album.is_compilation:
+        tags_['compilation'] = '1'
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "md5": info['md5'],
+            "duration": info['duration'], "tags": tags_}
+
+
+def convert_song(album, song_flac, overwrite=False, reuse=None,
+                 probe=()) -> dict:
+    '''Converts a single flac file into the dst_format of every target of the
+       album, decoding it only once. Runs inside a worker process, so instead
+       of printing anything it returns a result dict with the status ('done'
+       if anything was converted, 'skipped' otherwise), the path in the first
+       target, the path and status of every output and the source info from
+       read_source. Existing files are only converted again if 'overwrite'
+       is set. Targets in 'reuse' (see ConversionPipeline._find_reusable)
+       get an existing file with the same audio instead, unless it's gone.
+       Existing files of the target numbers in 'probe' have their tags read
+       into the output's 'tags'. With the album's 'replaygain' set, the
+       song always goes through transcode_song, which measures its loudness
+       on the way (stored in the result as 'loudness').'''
+
+    source = read_source(album, song_flac)
+    reuse = reuse or {}
+    outputs = []
+    to_convert = []
+    for nr, target in enumerate(album.targets):
+        dst_song_path = get_dst_song_path(album, song_flac, target)
+        if dst_song_path.exists() and not overwrite:
+            output = {"dst": dst_song_path, "target": nr, "status": "skipped"}
+            if nr in probe:
+                # what's in the file decides whether the sync retags it later
+                output["tags"] = read_output_tags(dst_song_path)
+            outputs.append(output)
+            continue
+        output = {"dst": dst_song_path, "target": nr, "status": "done"}
+        outputs.append(output)
+        if nr in reuse:
+            src_path, src_tags, link = reuse[nr]
+            try:
+                with metrics.stage("reuse") as row:
+                    reuse_output(Path(src_path), dst_song_path,
+                                 target.dst_format, src_tags, source["tags"],
+                                 link)
+                    row["bytes_written"] = dst_song_path.stat().st_size
+                output["status"] = "reused"
+                continue
+            except (OSError, RuntimeError):
+                # removed or changed in the meantime, convert it after all
+                pass
+        to_convert.append((dst_song_path, target))
+    result = {"song": song_flac, "status": "done", "dst": outputs[0]["dst"],
+              "outputs": outputs, "source": source}
+    if all(x["status"] == "skipped" for x in outputs):
+        result["status"] = "skipped"
+    if not to_convert:
+        return result
+
+    # everything is written into partial files first and renamed only once
+    # it's complete, so an interrupted run never leaves a truncated file
+    # behind that would be skipped as already existing the next time
+    partial_paths = []
+    for dst_song_path, _ in to_convert:
+        dst_song_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_paths.append(get_partial_path(dst_song_path))
+    if write_throttle is None:
+        encoded_paths = partial_paths
+    else:
+        # encoded on the local disk first, then copied at a limited speed
+        encoded_paths = []
+        for partial_path in partial_paths:
+            fd, encoded_path = tempfile.mkstemp(suffix=partial_path.suffix)
+            os.close(fd)
+            encoded_paths.append(Path(encoded_path))
+
+    try:
+        if album.direct_transcode or album.replaygain:
+            with metrics.stage("transcode") as row:
+                loudness = transcode_song(
+                    song_flac, [(x, y[1].dst_format, y[1].ffmpeg_params)
+                                for x, y in zip(encoded_paths, to_convert)],
+                    source["tags"], album.replaygain)
+                if loudness is not None:
+                    loudness["duration"] = source["duration"]
+                    result["loudness"] = loudness
+                row["bytes_read"] = source["size"]
+                row["bytes_written"] = sum(x.stat().st_size
+                                           for x in encoded_paths)
+                row["subprocesses"] = 1
+        else:
+            from pydub import AudioSegment
+            with metrics.stage("decode") as row:
+                if read_throttle is None:
+                    seg = AudioSegment.from_file(song_flac)
+                else:
+                    seg = AudioSegment.from_file(
+                        io.BytesIO(read_throttled(song_flac)), format="flac")
+                row["bytes_read"] = source["size"]
+                row["subprocesses"] = 1
+            for encoded_path, (_, target) in zip(encoded_paths, to_convert):
+                with metrics.stage("encode") as row:
+                    seg.export(encoded_path, format=target.dst_format,
+                               parameters=target.ffmpeg_params.split(),
+                               tags=source["tags"])
+                    row["bytes_written"] = encoded_path.stat().st_size
+                    row["subprocesses"] = 1
+        if write_throttle is not None:
+            for encoded_path, partial_path in zip(encoded_paths,
+                                                  partial_paths):
+                with metrics.stage("write") as row:
+                    transfer_file(encoded_path, partial_path)
+                    row["bytes_written"] = partial_path.stat().st_size
+    except BaseException:
+        for partial_path in partial_paths:
+            partial_path.unlink(missing_ok=True)
+        raise
+    finally:
+        if write_throttle is not None:
+            for encoded_path in encoded_paths:
+                encoded_path.unlink(missing_ok=True)
+
+    for partial_path, (dst_song_path, _) in zip(partial_paths, to_convert):
+        os.replace(partial_path, dst_song_path)
+    return result
+
+
+def get_partial_path(dst_song_path) -> Path:
+    '''Returns the hidden path a song is written to before it's complete.'''
+
+    return dst_song_path.with_name("." + dst_song_path.name + ".partial")
+
+
+def run_song_job(job, album, song_flac, *args) -> dict:
+    '''Runs convert_song or update_song_tags inside a worker process and
+       hands the metrics collected on the way back with the result.'''
+
+    mark = len(metrics.rows)
+    try:
+        result = job(album, song_flac, *args)
+    except MemoryError as e:
+        # pydub's MemoryError has no message at all
+        raise RuntimeError("out of memory, see max_job_memory") from e
+    finally:
+        rows = metrics.take(mark, album, song_flac)
+    result["metrics"] = rows
+    return result
+
+
+def update_song_tags(album, song_flac, extra_tags=None, targets=None) -> dict:
+    '''Rewrites the tags of an already converted song in every target (or
+       only the given target numbers) from its flac file plus extra_tags
+       (ReplayGain), leaving the audio alone. Runs inside a worker process
+       like convert_song and returns the same kind of result dict.'''
+
+    source = read_source(album, song_flac)
+    tags_ = {**source["tags"], **(extra_tags or {})}
+    if targets is None:
+        targets = range(len(album.targets))
+    outputs = []
+    for nr in targets:
+        target = album.targets[nr]
+        dst_song_path = get_dst_song_path(album, song_flac, target)
+        with metrics.stage("retag") as row:
+            retag_song(dst_song_path, target.dst_format, tags_)
+            row["bytes_written"] = dst_song_path.stat().st_size
+            row["bytes_read"] = row["bytes_written"]
+            row["subprocesses"] = 1
+        outputs.append({"dst": dst_song_path, "target": nr,
+                        "status": "retagged"})
+    return {"song": song_flac, "status": "retagged", "dst": outputs[0]["dst"],
+            "outputs": outputs, "source": source}
+
+
+def transcode_song(song_flac, outputs, tags_, analyse=False):
+    '''Lets a single ffmpeg process read song_flac and write all the outputs
+       (a list of (dst_song_path, dst_format, ffmpeg_params)) directly, so
+       the song is decoded once and streamed instead of being decoded into
+       memory and written to a temporary wav file first like AudioSegment
+       does. The options of every output mirror AudioSegment.export: the
+       encoder from DEFAULT_CODECS, ffmpeg_params, then the tags. With
+       'analyse' set, the same decoded audio also goes through ffmpeg's
+       EBU R128 meter and its loudness is returned (see parse_ebur128),
+       otherwise None.'''
+
+    # the meter's summary is only logged at the info level
+    command = ["ffmpeg", "-y", "-v", "info" if analyse else "error",
+               "-nostats", "-hide_banner"]
+    if read_throttle is None:
+        command.extend(["-i", str(song_flac)])
+    else:
+        # fed through stdin at a limited speed by run_ffmpeg
+        command.extend(["-f", "flac", "-i", "pipe:0"])
+    for dst_song_path, dst_format, ffmpeg_params in outputs:
+        # embedded pictures would otherwise become a video stream
+        # and the flac's own tags would be copied on top of tags_
+        command.extend(["-vn", "-map_metadata", "-1"])
+        if dst_format in DEFAULT_CODECS:
+            command.extend(["-acodec", DEFAULT_CODECS[dst_format]])
+        command.extend(ffmpeg_params.split())
+        command.extend(get_tag_params(dst_format, tags_))
+        command.extend(["-f", dst_format, str(dst_song_path)])
+    if analyse:
+        # framelog=verbose keeps the line logged every 100 ms below the info
+        # level, only the summary is left
+        command.extend(["-map", "0:a", "-af",
+                        "ebur128=peak=true:framelog=verbose", "-f", "null",
+                        "-"])
+    stderr = run_ffmpeg(command, *[x for x, _, _ in outputs],
+                        stdin_path=(None if read_throttle is None
+                                    else song_flac))
+    if analyse:
+        return parse_ebur128(stderr)
+    return None
+
+
+def parse_ebur128(stderr) -> dict:
+    '''Reads the integrated loudness (LUFS) and the true peak (dBFS) from
+       the summary the ebur128 filter logs at the end. Either is None if it
+       isn't there, or for the loudness, if the song is silent.'''
+
+    loudness = {"integrated": None, "peak": None}
+    for key, pattern in [("integrated", r"I:\s+(\S+) LUFS"),
+                         ("peak", r"Peak:\s+(\S+) dBFS")]:
+        matches = re.findall(pattern, stderr)
+        if not matches:
+            continue
+        try:
+            value = float(matches[-1])
+        except ValueError:
+            continue
+        if math.isfinite(value):
+            loudness[key] = value
+    return loudness
+
+
+def get_album_loudness(loudnesses):
+    '''Combines the loudness of an album's songs: the integrated loudness is
+       the mean of the songs' energy weighted by their durations, the peak
+       the highest one. Returns None if there's nothing to combine.'''
+
+    total_duration = sum(x["duration"] for x in loudnesses)
+    energy = sum(x["duration"] * 10 ** (x["integrated"] / 10)
+                 for x in loudnesses if x["integrated"] is not None)
+    if not total_duration or not energy:
+        return None
+    peaks = [x["peak"] for x in loudnesses if x["peak"] is not None]
+    return {"integrated": 10 * math.log10(energy / total_duration),
+            "peak": max(peaks) if peaks else None,
+            "duration": total_duration}
+
+
+def get_replaygain_tags(track_loudness, album_loudness=None) -> dict:
+    '''Turns measured loudness into REPLAYGAIN_* tags: the gain towards the
+       ReplayGain 2.0 reference of -18 LUFS and the peak as a linear
+       amplitude.'''
+
+    tags_ = {}
+    for name, loudness in [("TRACK", track_loudness),
+                           ("ALBUM", album_loudness)]:
+        if loudness is None or loudness["integrated"] is None:
+            continue
+        tags_[f"REPLAYGAIN_{name}_GAIN"] = (
+            f"{REPLAYGAIN_REFERENCE - loudness['integrated']:.2f} dB")
+        if loudness["peak"] is not None:
+            tags_[f"REPLAYGAIN_{name}_PEAK"] = (
+                f"{10 ** (loudness['peak'] / 20):.6f}")
+    return tags_
+
+
+def retag_song(dst_song_path, dst_format, tags_, src_path=None) -> None:
+    '''Replaces all the tags of an already converted song with tags_ without
+       encoding it again: ffmpeg copies the audio stream as it is (from
+       src_path, if given) into a temporary file, which then replaces the
+       old one.'''
+
+    if src_path is None:
+        src_path = dst_song_path
+    tmp_path = dst_song_path.with_name("." + dst_song_path.name + ".retag")
+    command = ["ffmpeg", "-y", "-v", "error", "-i", str(src_path),
+               "-map", "0", "-c", "copy", "-map_metadata", "-1"]
+    command.extend(get_tag_params(dst_format, tags_))
+    command.extend(["-f", dst_format, str(tmp_path)])
+    run_ffmpeg(command, tmp_path)
+    os.replace(tmp_path, dst_song_path)
+
+
+def reuse_output(src_path, dst_song_path, dst_format, src_tags, tags_,
+                 link) -> None:
+    '''Puts src_path, a file converted before from the same audio with the
+       same settings, at dst_song_path instead of encoding the song again.
+       If the tags are the same, it's hardlinked (with 'link' set and both
+       on the same filesystem) or copied with transfer_file, otherwise
+       ffmpeg copies its audio stream with tags_, like retag_song does.'''
+
+    dst_song_path.parent.mkdir(parents=True, exist_ok=True)
+    if src_tags != tags_:
+        retag_song(dst_song_path, dst_format, tags_, src_path)
+        return
+    partial_path = get_partial_path(dst_song_path)
+    partial_path.unlink(missing_ok=True)
+    transfer_file(src_path, partial_path, link)
+    os.replace(partial_path, dst_song_path)
+
+
+def get_tag_params(dst_format, tags_) -> list:
+    '''Builds the ffmpeg parameters for tags the same way
+       AudioSegment.export does, ID3v2.4 (its default) for mp3.'''
+
+    params = []
+    for key, value in tags_.items():
+        params.extend(["-metadata", f"{key}={value}"])
+    if dst_format == "mp3":
+        params.extend(["-id3v2_version", "4"])
+    return params
+
+
+def run_ffmpeg(command, *output_paths, stdin_path=None) -> str:
+    '''Runs an ffmpeg command, removing whatever it left at output_paths and
+       raising a RuntimeError with ffmpeg's own message if it fails. The file
+       at stdin_path, if given, is fed into ffmpeg's stdin within
+       max_read_speed. Returns what ffmpeg logged.'''
+
+    process = subprocess.Popen(command, stdin=(subprocess.DEVNULL
+                                               if stdin_path is None
+                                               else subprocess.PIPE),
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    if stdin_path is not None:
+        feeder = threading.Thread(target=feed_throttled,
+                                  args=(stdin_path, process.stdin))
+        feeder.start()
+    stderr = process.stderr.read().decode(errors="replace")
+    returncode = process.wait()
+    if stdin_path is not None:
+        feeder.join()
+    if returncode != 0:
+        for output_path in output_paths:
+            output_path.unlink(missing_ok=True)
+        error = stderr.strip().splitlines()
+        raise RuntimeError(error[-1] if error
+                           else f"ffmpeg exited with {returncode}")
+    return stderr
+
+
+def read_throttled(path) -> bytes:
+    '''Reads a whole file within max_read_speed.'''
+
+    chunks = []
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            read_throttle.wait(len(chunk))
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def feed_throttled(path, pipe) -> None:
+    '''Writes a file into a pipe within max_read_speed, stopping quietly if
+       the other side closes it.'''
+
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                read_throttle.wait(len(chunk))
+                pipe.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg failed and will tell why itself
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
 
-    for song_flac in album.picks_paths:
-        if (str(album.dst_path.name)
-                == str(song_flac.parent.relative_to(album.flac_path))):
-            dst_song_path = (album.dst_path
-                             / (song_flac.stem + "." + album.dst_format))
+def transfer_file(src, dst, link=False) -> str:
+    '''Puts a copy of src at dst the cheapest way the filesystems allow: a
+       hardlink if 'link' is set, a reflink (FICLONE, a copy-on-write clone
+       on Btrfs, XFS and the like), os.copy_file_range (copied inside the
+       kernel, or by the server on NFS and SMB) or a streamed copy, which
+       is kept within max_write_speed. Copies permissions and times like
+       shutil.copy2 does. Returns which of "hardlink", "reflink",
+       "copy_file_range" and "copy" was used.'''
+
+    if link:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            # another filesystem or no hardlinks there
+            pass
+    try:
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            method = _copy_contents(f_src, f_dst)
+        shutil.copystat(src, dst)
+    except BaseException:
+        Path(dst).unlink(missing_ok=True)
+        raise
+    return method
+
+
+def _copy_contents(f_src, f_dst) -> str:
+    # with a write limit everything has to go through the throttle
+    if write_throttle is None:
+        try:
+            import fcntl
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            return "reflink"
+        except (ImportError, OSError):
+            pass
+        if hasattr(os, "copy_file_range"):
+            size = os.fstat(f_src.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(f_src.fileno(),
+                                                f_dst.fileno(),
+                                                size - offset, offset, offset)
+                    if not copied:
+                        break
+                    offset += copied
+                return "copy_file_range"
+            except OSError:
+                # EXDEV across filesystems on older kernels, EINVAL or
+                # ENOSYS where it isn't supported; the explicit offsets left
+                # both file positions at the start
+                f_dst.truncate(0)
+    while chunk := f_src.read(CHUNK_SIZE):
+        if write_throttle is not None:
+            write_throttle.wait(len(chunk))
+        f_dst.write(chunk)
+    return "copy"
+
+
+def init_worker(limits, throttles) -> None:
+    '''Applies the resource limits to a worker process. Whatever ffmpeg
+       processes it starts inherit the priorities and the memory limit. The
+       bandwidth limits are the (read, write) 'throttles' created once for
+       all the workers, or None where there's no limit.'''
+
+    global read_throttle, write_throttle
+
+    if limits["nice"]:
+        os.nice(limits["nice"])
+    if limits["low_io_priority"] and shutil.which("ionice"):
+        # best-effort class, lowest priority
+        subprocess.run(["ionice", "-c2", "-n7", "-p", str(os.getpid())],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if limits["max_job_memory"]:
+        import resource
+        max_bytes = int(limits["max_job_memory"] * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    read_throttle, write_throttle = throttles
+
+
+class ConversionPipeline:
+    '''Converts albums in the background. Songs of an album are handed to
+       a pool of 'jobs' worker processes as soon as the album is submitted,
+       so they're converted while the prompts for the next album are still
+       running. Nothing is printed while a prompt might be waiting for input:
+       report() prints a short summary between prompts and finish() prints
+       the per-song results, in order, album by album. A long-running caller
+       can print the albums that are already done with collect(wait=False)
+       and keep the same worker processes for the next ones. Converted songs
+       are recorded in the sync state and the journal if they're given.
+
+       Only 'jobs' songs are handed to the workers at a time, the rest wait
+       in a heap ordered by their length in samples (read from the flac
+       header), so the longest songs are started first and a long live
+       recording doesn't end up converting alone at the end of the queue.
+       While finish() waits, a progress line with the realtime factor, the
+       songs left and the estimated finish time is shown on terminals.
+
+       The resource 'limits' from the config lower the number of workers to
+       max_encoders, stop starting new songs while the load average is over
+       max_load and are applied to every worker by init_worker.
+
+       A worker process that dies (e.g. killed for using too much memory)
+       breaks the whole process pool: the songs that were being converted
+       fail and a new pool takes over the rest.
+
+       With 'reuse_outputs' ("link" or "copy") and a sync state, songs whose
+       audio was already converted with the same settings get the existing
+       file linked or copied (see reuse_output) instead of being encoded.'''
+
+    def __init__(self, jobs, state=None, journal=None, limits=None,
+                 reuse_outputs=False):
+        if limits is not None and limits["max_encoders"]:
+            jobs = min(jobs, limits["max_encoders"])
+        self.limits = limits
+        self.throttles = None
+        if limits is not None:
+            self.throttles = tuple(Throttle(x * 1e6) if x else None
+                                   for x in [limits["max_read_speed"],
+                                             limits["max_write_speed"]])
+        self.jobs = jobs
+        self.executor = self._start_executor()
+        self.max_load = 0 if limits is None else limits["max_load"]
+        # the load average while starting songs is paused, otherwise None
+        self.paused_load = None
+        self.retry_timer = None
+        self.albums = []
+        self.state = state
+        self.journal = journal
+        self.reuse_outputs = reuse_outputs
+        # (-samples, submission order, future, job) of songs not started yet
+        self.waiting = []
+        self.running = 0
+        self.order = 0
+        # seconds of audio of every uncollected song, by its future
+        self.durations = {}
+        self.collected = 0
+        self.audio_done = 0.0
+        # time spent with any song converting, idle time in --watch would
+        # make the realtime factor meaningless
+        self.busy_seconds = 0.0
+        self.started = None
+        self.show_progress = sys.stdout.isatty()
+        self.progress_width = 0
+        # done callbacks run in the executor's thread and may start the next
+        # song, which can call a done callback right away
+        self.lock = threading.RLock()
+
+    def submit(self, album, overwrite=False, songs=None) -> None:
+        '''Queues converting the album's songs, or only the given ones.'''
+
+        if songs is None:
+            songs = album.picks_paths
+        futures = []
+        for song_flac in songs:
+            info = read_flac_metadata(song_flac)
+            reuse = self._find_reusable(album, song_flac, info['md5'])
+            if all(nr in reuse or (not overwrite and get_dst_song_path(
+                       album, song_flac, target).exists())
+                   for nr, target in enumerate(album.targets)):
+                # nothing to encode, only a link, a copy or a skip
+                info['duration'], info['total_samples'] = 0.0, 0
+            # existing files the sync state doesn't know yet get their tags
+            # read, see SyncState.record
+            probe = set()
+            if self.state is not None:
+                probe = {nr for nr, target in enumerate(album.targets)
+                         if str(get_dst_song_path(album, song_flac, target))
+                         not in self.state.outputs}
+            futures.append((song_flac, self._schedule(
+                info['duration'], info['total_samples'], convert_song, album,
+                song_flac, overwrite, reuse, probe)))
+        self._dispatch()
+        if self.journal is not None:
+            album_nr = self.journal.add_album(album)
+            for song_flac, future in futures:
+                future.add_done_callback(self._journal_callback(album_nr,
+                                                                song_flac))
+        self.albums.append((album, futures))
+
+    def _find_reusable(self, album, song_flac, md5) -> dict:
+        '''Returns {target number: (path, tags, link)} for every target of
+           the song that has an existing file converted from the same audio
+           with the same settings, see SyncState.find_output.'''
+
+        if not self.reuse_outputs or self.state is None or md5 is None:
+            return {}
+        reuse = {}
+        for nr, target in enumerate(album.targets):
+            dst_song_path = get_dst_song_path(album, song_flac, target)
+            found = self.state.find_output(md5, target.dst_format,
+                                           target.ffmpeg_params,
+                                           str(dst_song_path))
+            if found is not None:
+                reuse[nr] = (*found, self.reuse_outputs == "link")
+        return reuse
+
+    def _journal_callback(self, album_nr, song_flac):
+        def callback(future):
+            if not future.cancelled() and future.exception() is None:
+                self.journal.song_finished(album_nr, song_flac)
+        return callback
+
+    def submit_retag(self, album) -> None:
+        '''Like submit, but only rewrites the tags (see update_song_tags).'''
+
+        # rewriting tags takes about the same short time for any song, so
+        # these just fill the gaps at the end
+        futures = [(song_flac, self._schedule(
+                        0.0, 0, update_song_tags, album, song_flac,
+                        self._get_replaygain_tags(album, song_flac)))
+                   for song_flac in album.picks_paths]
+        self._dispatch()
+        self.albums.append((album, futures))
+
+    def _get_replaygain_tags(self, album, song_flac) -> dict:
+        '''Returns the ReplayGain tags written into the song before, so that
+           updating the other tags doesn't drop them.'''
+
+        if self.state is None:
+            return {}
+        dst = str(get_dst_song_path(album, song_flac, album.targets[0]))
+        return self.state.outputs.get(dst, {}).get("replaygain", {})
+
+    def _schedule(self, duration, samples, *job) -> Future:
+        '''Puts run_song_job(*job) into the heap, _dispatch() starts it once
+           it's the longest one waiting and a worker is free. Returns a future
+           that is completed along with the job.'''
+
+        future = Future()
+        with self.lock:
+            heapq.heappush(self.waiting, (-samples, self.order, future, job))
+            self.order += 1
+            self.durations[future] = duration
+        return future
+
+    def _start_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+        if self.limits is None:
+            return ProcessPoolExecutor(max_workers=self.jobs)
+        return ProcessPoolExecutor(max_workers=self.jobs,
+                                   initializer=init_worker,
+                                   initargs=(self.limits, self.throttles))
+
+    def _replace_executor(self, broken) -> None:
+        '''Starts a new process pool instead of the broken one, unless that
+           already happened.'''
+
+        with self.lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.executor = self._start_executor()
+
+    def _dispatch(self) -> None:
+        with self.lock:
+            if self.waiting and self._is_overloaded():
+                if not self.running and (self.retry_timer is None
+                                         or not self.retry_timer.is_alive()):
+                    # nothing finishes to try again, so a timer does
+                    self.retry_timer = threading.Timer(5, self._dispatch)
+                    self.retry_timer.daemon = True
+                    self.retry_timer.start()
+                return
+            while self.waiting and self.running < self.jobs:
+                _, _, future, job = heapq.heappop(self.waiting)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                executor = self.executor
+                try:
+                    try:
+                        worker_future = executor.submit(run_song_job, *job)
+                    except BrokenExecutor:
+                        # a worker died before its songs' callbacks ran,
+                        # this song wasn't started so it gets a new pool
+                        self._replace_executor(executor)
+                        executor = self.executor
+                        worker_future = executor.submit(run_song_job, *job)
+                except Exception as e:
+                    # the song fails instead of waiting forever
+                    future.set_exception(e)
+                    continue
+                if self.started is None:
+                    self.started = time.monotonic()
+                self.running += 1
+                worker_future.add_done_callback(
+                    self._done_callback(future, executor))
+
+    def _is_overloaded(self) -> bool:
+        '''Returns True while the 1-minute load average is over max_load.'''
+
+        if not self.max_load or not hasattr(os, "getloadavg"):
+            return False
+        load = os.getloadavg()[0]
+        self.paused_load = load if load > self.max_load else None
+        return self.paused_load is not None
+
+    def _done_callback(self, future, executor):
+        def callback(worker_future):
+            with self.lock:
+                self.running -= 1
+                if isinstance(worker_future.exception(), BrokenExecutor):
+                    # only the songs that were running fail
+                    self._replace_executor(executor)
+                if has_encoded(worker_future):
+                    self.audio_done += self.durations.get(future, 0.0)
+                if not self.running and not self.waiting:
+                    self.busy_seconds += time.monotonic() - self.started
+                    self.started = None
+                self._dispatch()
+            # outside the lock, the future's own callbacks (like writing
+            # the journal) mustn't hold up dispatching the next songs
+            try:
+                future.set_result(worker_future.result())
+            except Exception as e:
+                future.set_exception(e)
+        return callback
+
+    def _print_progress(self) -> None:
+        '''Redraws the progress line, see get_progress_line.'''
+
+        with self.lock:
+            line = get_progress_line(self.durations, self.collected,
+                                     self.audio_done, self._elapsed())
+            if self.paused_load is not None:
+                line += (f" paused, load {self.paused_load:.1f} is over "
+                         + f"{self.max_load}")
+        print("\r" + line.ljust(self.progress_width), end='')
+        sys.stdout.flush()
+        self.progress_width = len(line)
+
+    def _elapsed(self) -> float:
+        if self.started is None:
+            return self.busy_seconds
+        return self.busy_seconds + time.monotonic() - self.started
+
+    def _clear_progress(self) -> None:
+        if self.progress_width:
+            print("\r" + " " * self.progress_width + "\r", end='')
+            self.progress_width = 0
+
+    def report(self) -> None:
+        '''Prints how many of the submitted songs are already converted.'''
+
+        futures = [future for _, album_futures in self.albums
+                   for _, future in album_futures]
+        if not futures:
+            return
+        done = [future for future in futures if future.done()]
+        failed = [future for future in done if future.exception()]
+        summary = (f"\n[{len(done)}/{len(futures)} songs converted in the "
+                   + "background")
+        if failed:
+            summary += f", {len(failed)} failed"
+        print(summary + "]")
+
+    def collect(self, wait=True) -> list:
+        '''Prints the result of every song of the albums that are finished
+           and forgets them, waiting for all the albums if 'wait' is set. A
+           song that fails is reported and doesn't stop the rest of the
+           batch. Returns the result dicts of the collected songs.'''
+
+        results = []
+        remaining = []
+        for album, album_futures in self.albums:
+            if not wait and not all(future.done()
+                                    for _, future in album_futures):
+                remaining.append((album, album_futures))
+                continue
+            album_results = []
+            print(f"\n\n--- Converting into {album.dst_path} ---")
+            for song_flac, future in album_futures:
+                if wait and self.show_progress:
+                    while not future.done():
+                        self._print_progress()
+                        futures_wait([future], timeout=0.5)
+                    self._clear_progress()
+                print()
+                print("Processing \"" + song_flac.name + "\"...", end='')
+                sys.stdout.flush()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"song": song_flac, "status": "failed",
+                              "error": str(e)}
+
+                if result["status"] == "done" and all(
+                        x["status"] in ("reused", "skipped")
+                        for x in result["outputs"]):
+                    print("REUSED")
+                elif result["status"] == "done":
+                    print("DONE")
+                elif result["status"] == "retagged":
+                    print("TAGS UPDATED")
+                elif result["status"] == "skipped":
+                    print(f"\n{result['dst'].stem} already exists, "
+                          + "skipping...")
+                else:
+                    print(f"FAILED ({result['error']})")
+                metrics.add(result.pop("metrics", []))
+                album_results.append(result)
+                if self.state is not None and result["status"] != "failed":
+                    self.state.record(album, result)
+                with self.lock:
+                    self.durations.pop(future, None)
+                    self.collected += 1
+            if album.replaygain:
+                self._write_replaygain(album, album_results)
+            results.extend(album_results)
+        self.albums = remaining
+        if self.state is not None and results:
+            self.state.save()
+        return results
+
+    def _write_replaygain(self, album, album_results) -> None:
+        '''Tags the songs converted in the album with the ReplayGain of their
+           measured loudness. The album gain also needs the loudness of the
+           album's songs converted in earlier runs, which the sync state
+           keeps; without it (or if a song failed) only track gains are
+           written. Songs of earlier runs are tagged again if their album
+           gain changed.'''
+
+        # songs -> the key of their loudness: the audio md5, or the flac's
+        # path for files without one, which is only good for this run
+        loudness = {}
+        songs = {}
+        if self.state is not None:
+            songs = {x: y or str(x)
+                     for x, y in self.state.album_songs(album).items()}
+        failed = False
+        for result in album_results:
+            if result["status"] == "failed":
+                failed = True
+                continue
+            if "source" not in result:
+                continue
+            key = result["source"]["md5"] or str(result["song"])
+            songs[Path(result["song"])] = key
+            if "loudness" in result:
+                loudness[key] = result["loudness"]
+        if self.state is not None:
+            self.state.loudness.update(
+                (x, y) for x, y in loudness.items()
+                if x not in map(str, songs))
+            loudness = {**self.state.loudness, **loudness}
+
+        measured = [loudness[x] for x in songs.values() if x in loudness]
+        album_loudness = None
+        if not failed and len(measured) == len(songs):
+            album_loudness = get_album_loudness(measured)
+
+        # only new files are known to have no ReplayGain tags yet
+        fresh = {Path(x["song"]): [y["target"] for y in x["outputs"]
+                                   if y["status"] in ("done", "reused")]
+                 for x in album_results if x["status"] != "failed"}
+        futures = []
+        for song_flac, key in songs.items():
+            if key not in loudness:
+                continue
+            tags_ = get_replaygain_tags(loudness[key], album_loudness)
+            targets = fresh.get(song_flac, [])
+            if self._get_replaygain_tags(album, song_flac) != tags_:
+                targets = [nr for nr, x in enumerate(album.targets)
+                           if get_dst_song_path(album, song_flac, x).exists()]
+            if not targets:
+                continue
+            # ahead of every song waiting, this album is only done after it
+            future = self._schedule(0.0, math.inf, update_song_tags, album,
+                                    song_flac, tags_, targets)
+            futures.append((future, tags_))
+        self._dispatch()
+
+        tagged = 0
+        for future, tags_ in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status": "failed", "error": str(e)}
+            metrics.add(result.pop("metrics", []))
+            with self.lock:
+                self.durations.pop(future, None)
+            if result["status"] == "failed":
+                print(f"\nWriting ReplayGain failed ({result['error']})")
+                continue
+            tagged += 1
+            if self.state is not None:
+                for output in result["outputs"]:
+                    record = self.state.outputs.get(str(output["dst"]))
+                    if record is not None:
+                        record["replaygain"] = tags_
+        if not tagged:
+            return
+        if album_loudness is not None:
+            gain = REPLAYGAIN_REFERENCE - album_loudness["integrated"]
+            print(f"\nReplayGain tags updated, album gain {gain:+.2f} dB")
         else:
-            dst_song_path = (album.dst_path
-                             / song_flac.parent.relative_to(album.flac_path)
-                             / (song_flac.stem + "." + album.dst_format))
-        print()
-        if not dst_song_path.exists():
-            print("Processing \"" + song_flac.name + "\"...", end='')
-            sys.stdout.flush()
-            seg = AudioSegment.from_file(song_flac)
-            if not dst_song_path.parent.exists():
-                dst_song_path.parent.mkdir(parents=True, exist_ok=True)
-            tags_ = mediainfo(song_flac).get('TAG', {})
-            if album.is_compilation:
-                tags_['compilation'] = '1'
-            seg.export(dst_song_path, format=album.dst_format,
-                       parameters=album.ffmpeg_params.split(),
-                       tags=tags_)
-            print("DONE")
+            print("\nReplayGain tags updated, without the album gain as "
+                  + "not every song of the album was measured")
+
+    def finish(self) -> list:
+        '''Waits for all the songs and prints their results (see collect),
+           then stops the worker processes. Returns the result dicts of all
+           songs that weren't collected before.'''
+
+        results = self.collect()
+        self.executor.shutdown()
+        if self.state is not None:
+            self.state.save()
+
+        failed = [x for x in results if x["status"] == "failed"]
+        if self.audio_done:
+            elapsed = self._elapsed()
+            print(f"\n{format_seconds(self.audio_done)} of audio in "
+                  + f"{format_seconds(elapsed)}, "
+                  + f"{self.audio_done / elapsed:.1f}x realtime.")
+        if failed:
+            print(f"\nAll conversions done, {len(failed)} failed:")
+            for result in failed:
+                print(f"  {result['song']}: {result['error']}")
+            if self.journal is not None:
+                print("Use --resume to try the failed songs again.")
         else:
-            print(f"\n{dst_song_path.stem} already exists, skipping...")
-    print("\nAll conversions done.")
-    return
+            print("\nAll conversions done.")
+            if self.journal is not None:
+                self.journal.remove()
+        return results
+
+
+def has_encoded(future) -> bool:
+    '''Tells whether the finished song job actually encoded any output, only
+       those count as converted audio for the realtime factor.'''
+
+    if future.exception() is not None:
+        return False
+    result = future.result()
+    return result["status"] == "done" and any(
+        x["status"] == "done" for x in result["outputs"])
+
+
+def get_progress_line(durations, collected, audio_done, elapsed) -> str:
+    '''Returns a line like "[12/40 songs done, 28 left, 31.5x realtime,
+       ETA 4m10s at 21:37]" for the futures in 'durations' (the seconds of
+       audio of each song) and 'collected' songs done before. The realtime
+       factor is the audio converted so far per second of 'elapsed', the
+       ETA assumes the rest goes just as fast.'''
+
+    total = collected + len(durations)
+    left = [duration for future, duration in durations.items()
+            if not future.done()]
+    line = f"[{total - len(left)}/{total} songs done, {len(left)} left"
+    if audio_done:
+        speed = audio_done / max(elapsed, 1e-6)
+        eta = sum(left) / speed
+        finish_time = time.strftime("%H:%M",
+                                    time.localtime(time.time() + eta))
+        line += (f", {speed:.1f}x realtime, ETA {format_seconds(eta)} at "
+                 + finish_time)
+    return line + "]"
+
+
+def format_seconds(seconds) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02}s"
+    return f"{seconds}s"
+
+
+def convert_songs(albums, jobs, state=None) -> list:
+    '''Converts all flac files of all the albums into dst_format preserving
+       subdirs, spreading the songs of every album across 'jobs' worker
+       processes, longest songs first. Returns the result dicts of all
+       songs.'''
+
+    pipeline = ConversionPipeline(jobs, state)
+    for album in albums:
+        pipeline.submit(album)
+    return pipeline.finish()
+
+
+def resume_queue(cfg, state, journal_path) -> int:
+    '''Converts the songs left in the journal of an interrupted run, without
+       any prompts. Returns 1 if there was nothing to resume or something
+       failed again, 0 otherwise.'''
+
+    journal = Journal.load(journal_path)
+    if journal is None:
+        print("\nThere is no interrupted run to resume.")
+        return 1
+
+    pipeline = ConversionPipeline(cfg["jobs"], state, journal,
+                                  cfg["limits"], cfg["reuse_outputs"])
+    for album_nr, album in enumerate(journal.albums):
+        queue.append(album)
+        songs = journal.remaining_songs(album_nr)
+        if songs:
+            pipeline.submit(album, songs=songs)
+    results = pipeline.finish()
+    return 1 if [x for x in results if x["status"] == "failed"] else 0
+
+
+def run_manifest(cfg, state, journal=None, summary_file=None) -> int:
+    '''Builds the whole queue from the albums listed in a manifest file and
+       converts it without asking anything. Writes a json summary of every
+       album and song into the 'summary' file or prints it into summary_file
+       (stdout by default) at the end.
+       Returns the exit code: 1 if any album or song failed, 0 otherwise.'''
+
+    with open(cfg["manifest"]) as f:
+        if cfg["manifest"].suffix == ".json":
+            manifest = json.load(f)
+        else:
+            import yaml
+            manifest = yaml.safe_load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest.get("albums") or []
+
+    pipeline = ConversionPipeline(cfg["jobs"], state, journal,
+                                  cfg["limits"], cfg["reuse_outputs"])
+    summary = []
+    submitted = []
+    for entry in manifest:
+        if not isinstance(entry, dict):
+            entry = {"source": entry}
+        album_summary = {"source": str(entry.get("source")),
+                         "destination": None, "error": None, "songs": []}
+        summary.append(album_summary)
+        try:
+            album = get_manifest_album(cfg, entry)
+        except (KeyError, ValueError, OSError) as e:
+            album_summary["error"] = str(e)
+            print(f"\nSkipping {album_summary['source']}: {e}")
+            continue
+        album_summary["destination"] = str(album.dst_path)
+        queue.append(album)
+        pipeline.submit(album)
+        submitted.append((album, album_summary))
+    if cfg["library"] is not None:
+        cfg["library"].flush()
+
+    results = iter(pipeline.finish())
+    for album, album_summary in submitted:
+        for _ in album.picks_paths:
+            result = next(results)
+            album_summary["songs"].append(
+                {"song": str(result["song"]), "status": result["status"],
+                 "dst": str(result["dst"]) if "dst" in result else None,
+                 "error": result.get("error")})
+
+    songs = [x for album in summary for x in album["songs"]]
+    counts = {status: len([x for x in songs if x["status"] == status])
+              for status in ["done", "skipped", "failed"]}
+    counts["failed_albums"] = len([x for x in summary if x["error"]])
+    report = {"albums": summary, "counts": counts}
+    if cfg["summary"] is not None:
+        write_json(cfg["summary"], report)
+    else:
+        print(json.dumps(report, indent=2),
+              file=summary_file or sys.stdout)
+    return 1 if counts["failed"] or counts["failed_albums"] else 0
+
+
+def get_manifest_album(cfg, entry) -> AlbumToProcess:
+    '''Turns a single manifest entry into an AlbumToProcess. Only 'source'
+       is required: 'destination' defaults to <artist>/<album> from the tags
+       like with --skip-dir-prompts, 'compilation' to the --compilation
+       options, 'tracks' (numbers as pick_songs lists them or file names)
+       to the entire album and 'cover' (an image inside the album folder to
+       be copied as the main cover art) to none. Raises ValueError for
+       entries that can't be processed.'''
+
+    flac_album_path = Path(entry["source"])
+    if not flac_album_path.is_absolute():
+        flac_album_path = cfg["flac_albums_dir"] / flac_album_path
+    if not flac_album_path.is_dir():
+        raise ValueError(f"{flac_album_path} is not a directory")
+
+    all_flac_files_paths = pick_songs(flac_album_path, True, cfg["library"])
+    if not all_flac_files_paths:
+        raise ValueError(f"no flac files found in {flac_album_path}")
+    if entry.get("tracks") is None:
+        song_picks_paths = all_flac_files_paths
+    else:
+        song_picks_paths = []
+        for track in entry["tracks"]:
+            if isinstance(track, int):
+                if not 0 <= track < len(all_flac_files_paths):
+                    raise ValueError(f"there is no track number {track}")
+                song_picks_paths.append(all_flac_files_paths[track])
+                continue
+            matches = [x for x in all_flac_files_paths
+                       if track in (x.name, x.relative_to(
+                           flac_album_path).as_posix())]
+            if not matches:
+                raise ValueError(f"track {track} not found")
+            song_picks_paths.append(matches[0])
+
+    if entry.get("destination") is None:
+        artist_name, album_name = get_artist_and_album(song_picks_paths[0],
+                                                       cfg["library"])
+        if not artist_name or not album_name:
+            raise ValueError("no ARTIST or ALBUM tag found, a destination "
+                             + "is needed")
+        dst_album_path = cfg["dst_albums_dir"] / artist_name / album_name
+    else:
+        # relative destinations are inside dst_albums_dir
+        dst_album_path = cfg["dst_albums_dir"] / entry["destination"]
+
+    is_compilation = entry.get("compilation", cfg["is_compilation"])
+
+    if entry.get("cover") is not None:
+        cover_path = flac_album_path / entry["cover"]
+        if not cover_path.is_file():
+            raise ValueError(f"cover art {cover_path} not found")
+        copy_main_cover_art(cover_path, dst_album_path,
+                            cfg["default_cover_art_name"],
+                            cfg["hardlink_cover_art"])
+
+    return AlbumToProcess(dst_album_path, song_picks_paths, flac_album_path,
+                          cfg["ffmpeg_params"], cfg["dst_format"],
+                          bool(is_compilation), cfg["direct_transcode"],
+                          get_extra_targets(cfg, dst_album_path),
+                          cfg["replaygain"])
+
+
+def sync_library(cfg, state) -> None:
+    '''Brings every file flac2lib converted before up to date with its flac
+       file. Songs whose audio changed (or whose converted file went missing)
+       are converted again with the settings used the first time, songs
+       where only the tags changed just get their tags rewritten. Files whose
+       flac is gone are deleted if 'prune' is set. With 'retag' only tags are
+       updated and with 'dry_run' the differences are only printed.'''
+
+    print("\n\n--- Sync ---\n")
+    outdated, orphaned = state.diff()
+    to_convert = []
+    to_retag = []
+    for dst, record, reason in outdated:
+        if reason == "tags changed":
+            print(f"~ {dst} ({reason})")
+            to_retag.append(record)
+        elif cfg["retag"]:
+            print(f"! {dst} ({reason}, use --sync to convert it again)")
+        else:
+            print(f"~ {dst} ({reason})")
+            to_convert.append(record)
+    for dst, _ in orphaned:
+        if cfg["prune"]:
+            print(f"- {dst} (flac removed)")
+        else:
+            print(f"! {dst} (flac removed, use --prune to delete)")
+    if not outdated and not orphaned:
+        print("Everything is up to date.")
+
+    if cfg["dry_run"]:
+        return
+
+    if cfg["prune"]:
+        for dst, _ in orphaned:
+            prune_output(Path(dst), cfg["dst_albums_dir"])
+            state.forget(dst)
+
+    if not to_convert and not to_retag:
+        state.save()
+        return
+    pipeline = ConversionPipeline(cfg["jobs"], state, limits=cfg["limits"],
+                                  reuse_outputs=cfg["reuse_outputs"])
+    for album in group_records(to_convert, cfg["direct_transcode"],
+                               cfg["replaygain"]):
+        pipeline.submit(album, overwrite=True)
+    for album in group_records(to_retag, cfg["direct_transcode"],
+                               cfg["replaygain"]):
+        pipeline.submit_retag(album)
+    pipeline.finish()
+
+
+def group_records(records, direct_transcode, replaygain=False) -> list:
+    '''Turns sync state records back into AlbumToProcess objects, one per
+       album, with the settings the songs were converted with.'''
+
+    albums = {}
+    for record in records:
+        key = (record["flac_path"], record["dst_path"])
+        if key not in albums:
+            albums[key] = AlbumToProcess(Path(record["dst_path"]), [],
+                                         Path(record["flac_path"]),
+                                         record["ffmpeg_params"],
+                                         record["dst_format"],
+                                         record["is_compilation"],
+                                         direct_transcode,
+                                         replaygain=replaygain)
+        albums[key].picks_paths.append(Path(record["src"]))
+    return list(albums.values())
+
+
+def prune_output(dst_song_path, dst_albums_dir) -> None:
+    '''Deletes a converted song along with any folders inside dst_albums_dir
+       that are left empty.'''
+
+    dst_song_path.unlink(missing_ok=True)
+    for parent in dst_song_path.parents:
+        if (parent == dst_albums_dir
+                or not parent.is_relative_to(dst_albums_dir)):
+            break
+        try:
+            parent.rmdir()
+        except OSError:
+            # not empty, cover art or other songs are still there
+            break
+
+
+# folders of a multi-CD album that belong to the folder above them
+DISC_FOLDER = re.compile(r"(cd|disc|disk)\s*\d+", re.IGNORECASE)
+
+
+def watch_library(cfg, state) -> None:
+    '''Runs until interrupted, converting albums that appear or change in
+       flac_albums_dir without any prompts, like a manifest entry with only
+       the source. Changes are noticed with inotify where possible and by
+       refreshing the library index every 'watch_interval' seconds
+       otherwise. An album is only converted once its flac files haven't
+       changed for 'watch_settle_time' seconds, so albums that are still
+       being copied or ripped are left alone. The albums seen so far are kept
+       in cache_dir/watch_state.json, the ones already there the first time
+       are not converted.'''
+
+    library = cfg["library"]
+    if library is None:
+        # finding out what changed without walking everything needs the index
+        library = LibraryIndex(cfg["flac_albums_dir"],
+                               cfg["cache_dir"] / "library_index.json")
+        cfg["library"] = library
+    watch_state_path = cfg["cache_dir"] / "watch_state.json"
+    seen = None
+    try:
+        with open(watch_state_path) as f:
+            data = json.load(f)
+        if data["root"] == str(library.root):
+            seen = data["albums"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    try:
+        watcher = InotifyWatcher()
+    except OSError as e:
+        print(f"\ninotify can't be used ({e}), checking the library every "
+              + f"{cfg['watch_interval']} seconds instead.")
+        watcher = PollingWatcher()
+
+    library.refresh()
+    if seen is None:
+        seen = get_watched_albums(library)
+        write_json(watch_state_path, {"root": str(library.root),
+                                      "albums": seen})
+
+    # the same worker processes are used for every album
+    pipeline = ConversionPipeline(cfg["jobs"], state, limits=cfg["limits"],
+                                  reuse_outputs=cfg["reuse_outputs"])
+    # album -> [signature of its flac files, when it last changed]
+    pending = {}
+    changed = None
+    print(f"\nWatching {library.root} for new albums, press Ctrl+C to stop.")
+    try:
+        while True:
+            try:
+                watcher.watch(str(library.root / x) for x in library.dirs)
+            except OSError as e:
+                print(f"\n{e}, checking the library every "
+                      + f"{cfg['watch_interval']} seconds instead.")
+                watcher = PollingWatcher()
+                changed = None
+            if changed is None or changed:
+                library.refresh()
+            albums = get_watched_albums(library)
+            now = time.monotonic()
+
+            for rel, mtime in albums.items():
+                if seen.get(rel) != mtime:
+                    pending.setdefault(rel, [None, now])
+            # a file rewritten in place doesn't change the folder's mtime,
+            # inotify still tells which folder it's in
+            for path in changed or []:
+                rel = library._rel(path)
+                if rel and get_album_root(rel) in albums:
+                    pending.setdefault(get_album_root(rel), [None, now])
+            for rel in [x for x in seen if x not in albums]:
+                print(f"\n{library.root / rel} was removed.")
+                del seen[rel]
+                pending.pop(rel, None)
+                prune_watched_album(cfg, state, library.root / rel)
+                write_json(watch_state_path, {"root": str(library.root),
+                                              "albums": seen})
+
+            for rel in list(pending):
+                if rel not in albums:
+                    del pending[rel]
+                    continue
+                signature = get_album_signature(library, rel)
+                if signature != pending[rel][0]:
+                    pending[rel] = [signature, now]
+                    continue
+                if now - pending[rel][1] < cfg["watch_settle_time"]:
+                    continue
+                del pending[rel]
+                queue_watched_album(cfg, state, pipeline, library.root / rel)
+                seen[rel] = albums[rel]
+                write_json(watch_state_path, {"root": str(library.root),
+                                              "albums": seen})
+
+            library.flush()
+            pipeline.collect(wait=False)
+            changed = watcher.wait(cfg["watch_interval"])
+    except KeyboardInterrupt:
+        print("\nStopping, waiting for the songs that are being converted...")
+    pipeline.finish()
+
+
+def get_album_root(rel) -> str:
+    '''Returns the album folder a folder with flac files belongs to, which
+       is the folder above it for CD1, Disc 2 and the like.'''
+
+    parent, _, name = rel.rpartition("/")
+    if parent and DISC_FOLDER.fullmatch(name):
+        return parent
+    return rel
+
+
+def get_watched_albums(library) -> dict:
+    '''Returns the newest mtime of the folders of every album in the
+       library index, keyed by the album's path relative to the library.'''
+
+    albums = {}
+    for rel, entry in library.dirs.items():
+        if not rel or not entry["tracks"]:
+            continue
+        root = get_album_root(rel)
+        albums[root] = max(albums.get(root, 0), entry["mtime"])
+    return albums
+
+
+def get_album_signature(library, rel) -> list:
+    '''Returns the path, size and mtime of every flac file of an album,
+       which stays the same once nothing is writing to the album anymore.'''
+
+    signature = []
+    for song_flac in library.tracks(library.root / rel) or []:
+        try:
+            stat = song_flac.stat()
+        except OSError:
+            # moved or deleted since the index was refreshed
+            continue
+        signature.append((str(song_flac), stat.st_size, stat.st_mtime_ns))
+    return signature
+
+
+def queue_watched_album(cfg, state, pipeline, flac_album_path) -> None:
+    '''Queues a new or changed album found by watch_library. The album
+       goes into <artist>/<album> from the tags, an image called like the
+       default cover art, "cover", "folder" or "front" becomes the main
+       cover art. Songs converted before are handled like --sync would:
+       converted again if their audio changed, retagged if only their tags
+       did and left alone otherwise.'''
+
+    entry = {"source": str(flac_album_path)}
+    if cfg["cover_art"]:
+        cover_names = {cfg["default_cover_art_name"].lower(), "cover",
+                       "folder", "front"}
+        images, _ = list_cover_art(flac_album_path, cfg["cover_art_suffixes"])
+        covers = sorted(x for x in images if x.stem.lower() in cover_names)
+        if covers:
+            entry["cover"] = covers[0].relative_to(flac_album_path)
+    try:
+        album = get_manifest_album(cfg, entry)
+    except (ValueError, OSError) as e:
+        print(f"\nSkipping {flac_album_path}: {e}")
+        return
+
+    outdated, orphaned = state.diff({str(flac_album_path)})
+    to_convert = [record for _, record, reason in outdated
+                  if reason != "tags changed"]
+    to_retag = [record for _, record, reason in outdated
+                if reason == "tags changed"]
+    for outdated_album in group_records(to_convert, cfg["direct_transcode"],
+                                        cfg["replaygain"]):
+        pipeline.submit(outdated_album, overwrite=True)
+    for outdated_album in group_records(to_retag, cfg["direct_transcode"],
+                                        cfg["replaygain"]):
+        pipeline.submit_retag(outdated_album)
+    if cfg["prune"]:
+        prune_watched_album(cfg, state, flac_album_path, orphaned)
+
+    # everything converted before is already taken care of above
+    songs = [x for x in album.picks_paths
+             if any(str(get_dst_song_path(album, x, target))
+                    not in state.outputs for target in album.targets)]
+    if songs:
+        queue.append(album)
+        pipeline.submit(album, songs=songs)
+
+
+def prune_watched_album(cfg, state, flac_album_path, orphaned=None) -> None:
+    '''Deletes the converted songs of an album whose flac files are gone
+       if 'prune' is set.'''
+
+    if not cfg["prune"]:
+        return
+    if orphaned is None:
+        _, orphaned = state.diff({str(flac_album_path)})
+    for dst, _ in orphaned:
+        print(f"- {dst} (flac removed)")
+        prune_output(Path(dst), cfg["dst_albums_dir"])
+        state.forget(dst)
+    if orphaned:
+        state.save()
 
 
 if __name__ == "__main__":